@@ -61,4 +61,44 @@ class QueueHandler(logging.Handler):
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
-            self.handleError(record)
\ No newline at end of file
+            self.handleError(record)
+
+class BatchQueueHandler(QueueHandler):
+    """
+    A QueueHandler that sends its records as lists of up to capacity records,
+    rather than one at a time, to save on pickling and queue traffic.
+    Records at or above flush_level are sent straight away, along with any
+    buffered before them. Call flush() to send the rest.
+    """
+
+    def __init__(self, queue, capacity=256, flush_level=logging.WARNING):
+        QueueHandler.__init__(self, queue)
+        self.capacity = capacity
+        self.flush_level = flush_level
+        self.buffer = []
+
+    def emit(self, record):
+        """
+        Prepare a record and add it to the buffer, sending the buffer when
+        it is full or the record is important enough.
+        """
+        try:
+            self.buffer.append(self.prepare(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+        if len(self.buffer) >= self.capacity or record.levelno >= self.flush_level:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the buffered records as a single list.
+        """
+        self.acquire()
+        try:
+            if self.buffer:
+                self.enqueue(self.buffer)
+                self.buffer = []
+        finally:
+            self.release()
@@ -8,268 +8,679 @@ Need to do this in a way that they can be compared, and only added if unique.
 
 """
 import os, sys
+import argparse
+import datetime
+import time
 import itertools
 import logging
-from nbt.nbt import TAG_List, TAG_Long, TAG_Byte, TAG_Byte_Array, TAG_Int,TAG_Compound
+import glob
+from nbt.nbt import TAG_Long, TAG_Byte, TAG_Int, NBTFile, MalformedFileError
 import nbt
-from multiprocessing import Pool,Queue
+from io import BytesIO
+from multiprocessing import Pool,Queue,cpu_count
+from multiprocessing.pool import ThreadPool
 import threading
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
 import json
-from utilities import array_4bit_to_byte, array_byte_to_4bit, unpack_nbt, pack_nbt, to_json, DelayedKeyboardInterrupt
-from QueueHandler import QueueHandler
+import shutil
+import tempfile
+import cProfile
+import numpy as np
+from utilities import (decode_arrays, encode_section, block_states, section_index,
+                       pack_nbt, to_json, DelayedKeyboardInterrupt, BLOCK_STATES)
+from QueueHandler import BatchQueueHandler
+from replacement_rules import load_rules
+from region_io import (serialize_chunk, compress_record, write_record, rewrite_region,
+                       replace_file, RegionReader, ChunkWriter, COMPRESSION_LEVELS)
+from manifest import Manifest, file_signature, rules_digest
+from block_index import BlockIndex
+from nbt_reader import read_chunk
+from inventory import CompactInventory, Inventory, NO_SIGNATURE
+from inventory_file import InventoryColumns
+from shared_counts import SharedCounts
+from timing import PhaseTimer, format_phases, write_report, merge_profiles
+from targeting import Target, load_chunk_list
+
+# Kinds of changes counted per rule, and how they are reported
+CHANGE_KINDS = OrderedDict([("blocks", "%d blocks changed"),
+                            ("tiles_deleted", "%d tile entities deleted"),
+                            ("tags_edited", "%d NBT tags edited")])
 
 # Default tags to remove, eventually make this loaded from a file
 tags_to_strip = ["id", "x", "y", "z", "Items", "facing"]
-replacements={}
-
-# This function takes a flag, and tile_data dict(dict(dict))
-# and flattens it back into a TAG_List
-def flatten_tile_entity(tile_data):
-    tile_entities = TAG_List(type=TAG_Compound)
-    for _,value_x in tile_data.viewitems():
-        for _,value_y in value_x.viewitems():
-            while True:
-                try:
-                    (_,tile) = value_y.popitem()
-                    tile_entities.append(tile)
-                except:
-                    break
-    return tile_entities
-
-# This function takes an array of block IDs and data, and creates the Add 
-# bytearray if necessary, as well as converts all data to TAG_Byte_Array
-def parse_block_info(blocks,data):
-    add = [0] * 4096
-    for i,_ in enumerate(blocks):
-        if blocks[i] > 255:
-            add[i] = blocks[i]//256
-            blocks[i] -= add[i] * 256
-    add_list = TAG_Byte_Array(name=unicode("Add"))
-    add_list.value = array_byte_to_4bit(bytearray(add))
-    block_list =TAG_Byte_Array(name=unicode("Blocks"))
-    block_list.value = bytearray(blocks)
-    data_list =TAG_Byte_Array(name=unicode("Data"))
-    data_list.value = array_byte_to_4bit(bytearray(data))
-    return (block_list,data_list,add_list)
-
-def write_block_data(region_data,output_file):
-    # initialize with data from first region
-    world_data = region_data[0]
-    for region in region_data[1:]:
-        for block in region:
-            try:
-                world_data.index(block)
-                # We've already seen this exact block
-            except ValueError:
-                world_data.append(block)
-    out_file = open(output_file, "w+")
-    out_file.write("Block ID,Data,NBT ID,NBT\n")
-    for block in world_data:
-        #print("Block: {0}:{1} ID: {2} Data: {3}".format(block[0],block[1], block[2], json.dumps(block[3], default=to_json)))
-        out_file.write("{0};{1};{2};{3}\n".format(block[0],block[1], block[2], block[3]))
+OUTPUT_FILE = "output.txt"
+# Kept next to OUTPUT_FILE, see manifest.py
+MANIFEST_FILE = "output.manifest.json"
+# Inventory of each dimension, when there are several
+DIMENSIONS_FILE = "output.dimensions.txt"
+# Written with --shared-counts, see shared_counts.py
+COUNTS_FILE = "output.counts.npz"
+# Written with --columnar-output, see inventory_file.py
+INVENTORY_FILE = "output.inventory.npz"
+
+# Index the tile entities of a chunk once, by section Y and then by the
+# packed index of their block within that section
+def index_tile_entities(level):
+    tiles = defaultdict(dict)
+    for tile_entity in level["TileEntities"]:
+        x = tile_entity["x"].value
+        y = tile_entity["y"].value
+        z = tile_entity["z"].value
+        tiles[y >> 4][section_index(x, y, z)] = tile_entity
+    return tiles
+
+# index_tile_entities() for a chunk read with nbt_reader, where tile
+# entities are plain dicts
+def index_tile_values(level):
+    tiles = defaultdict(dict)
+    for tile_entity in level.get("TileEntities", ()):
+        (x, y, z) = (tile_entity["x"], tile_entity["y"], tile_entity["z"])
+        tiles[y >> 4][section_index(x, y, z)] = tile_entity
+    return tiles
+
+class TileJournal(object):
+    """
+    The tile entity changes made to a chunk, by (section Y, index within the
+    section) position. NBT edits are made to the tile entity tags in place,
+    so they are only noted. apply() then updates the TileEntities list once
+    for the whole chunk, leaving the other entries where they were.
+    """
+    def __init__(self):
+        self.deleted = set()
+        self.edited = set()
+        self.added = {}
+
+    def __len__(self):
+        return len(self.deleted) + len(self.edited) + len(self.added)
+
+    def delete(self, position):
+        self.edited.discard(position)
+        if self.added.pop(position, None) is None:
+            self.deleted.add(position)
+
+    def edit(self, position):
+        self.edited.add(position)
+
+    def add(self, position, tile):
+        """Add a tile entity, in place of the one at its position if there is one"""
+        self.deleted.add(position)
+        self.added[position] = tile
+
+    def apply(self, tile_entities):
+        """Apply the changes to a TileEntities TAG_List"""
+        if self.deleted:
+            tile_entities.tags = [tile for tile in tile_entities.tags if
+                                  (tile["y"].value >> 4, section_index(tile["x"].value, tile["y"].value,
+                                                                       tile["z"].value)) not in self.deleted]
+        tile_entities.tags.extend(self.added.viewvalues())
+
+# Strip the position and other noisy tags from a tile entity, and return it
+# as a JSON string. Equal strings are interned in signatures, so every
+# distinct signature is only kept in memory once per region.
+# The tile entity is a plain dict as returned by nbt_reader, it is stripped
+# in place.
+def tile_signature(stripped_tags, signatures):
+    for tag in tags_to_strip:
+        stripped_tags.pop(tag,None)
+    stripped_tags = json.dumps(stripped_tags, default=to_json)
+    return signatures.setdefault(stripped_tags, stripped_tags)
+
+# Write the world inventory, a Counter of
+# (block ID, data, tile entity ID, stripped NBT) -> occurrences, or an
+# inventory.Inventory
+# The file is written under a temporary name first, so readers never see
+# a partially written output file.
+def write_block_data(world_data,output_file):
+    temp_file = output_file + ".tmp"
+    out_file = open(temp_file, "w+")
+    out_file.write("Block ID,Data,NBT ID,NBT,Count\n")
+    for block,count in sorted(world_data.viewitems()):
+        out_file.write("{0};{1};{2};{3};{4}\n".format(block[0],block[1], block[2], block[3], count))
     out_file.close()
+    replace_file(temp_file, output_file)
 
-def process_block_change(title,block,data,tile,z,replace_info,chunk_modified, tile_entity_modified):
-    try:
-        # If toID is omitted then no change is made
-        block = replace_info["toID"]
-        process_region.logger.debug("Changing ID: %s to %s", title, replace_info["toID"])
-        chunk_modified = True
-    except:
-        pass
-    try:
-        # If toData is omitted then no change is made  
-        data = replace_info["toData"]
-        process_region.logger.debug("Changing Data: %s to %s",title, replace_info["toData"])
-        chunk_modified = True
-    except:
-        pass
-   	try:
-		# If toData is omitted then no change is made  
-		data += replace_info["adjustData"]
-		process_region.logger.debug("Adjusting Data: %s to %s",title, replace_info["adjustData"])
-		chunk_modified = True
-	except:
-		pass
-    try:
-        # If delete property specified, try to remove the tile entity
-        replace_info["delete"]
-        if (tile.pop(z,None) != None):
-            process_region.logger.debug("Deleted Tile Data: %s",title)
-            chunk_modified = True
-            tile_entity_modified = True
-    except:
+# write_block_data() for the inventories of several dimensions, given as
+# {dimension: inventory}, with the dimension in the first column
+def write_dimension_data(dimension_data, output_file):
+    temp_file = output_file + ".tmp"
+    out_file = open(temp_file, "w+")
+    out_file.write("Dimension,Block ID,Data,NBT ID,NBT,Count\n")
+    for dimension in sorted(dimension_data):
+        for block,count in sorted(dimension_data[dimension].viewitems()):
+            out_file.write("{0};{1};{2};{3};{4};{5}\n".format(dimension, block[0], block[1], block[2],
+                                                             block[3], count))
+    out_file.close()
+    replace_file(temp_file, output_file)
+
+class ResultAggregator(object):
+    """
+    Merges the results of finished tasks into a running world inventory as
+    they arrive, so per region data can be dropped straight away. The
+    inventory is written to the output file every flush_interval seconds,
+    along with a progress report.
+    For incremental runs finished regions are recorded in the manifest, with
+    the (mtime, size) they had when they were scheduled from file_signatures.
+    Replacement runs also mark them as done with the rules_digest.
+    When building a block index, finished regions are written to it as well.
+    With keep_region_stats the stats of each region are kept apart too, for
+    the timing report. With shared_counts, blocks without a tile entity are
+    counted there rather than in the results, and are added in when writing.
+    Given region_tags, mapping region files to their dimension, an inventory
+    is also kept per dimension, and written to dimension_file.
+    Given an inventory_file.InventoryColumns, the counts of every region are
+    gathered there as well, and written to columns_file.
+    """
+    def __init__(self, tasks, output_file, flush_interval, logger,
+                 manifest=None, file_signatures=None, rules_digest=None, index=None,
+                 keep_region_stats=False, shared_counts=None, region_tags=None, dimension_file=None,
+                 columns=None, columns_file=None):
+        self.world_data = Inventory()
+        self.columns = columns
+        self.columns_file = columns_file
+        self.shared_counts = shared_counts
+        self.region_tags = region_tags
+        self.dimension_data = defaultdict(Inventory) if region_tags is not None else None
+        self.dimension_file = dimension_file
+        self.stats = Counter()
+        self.region_stats = defaultdict(Counter) if keep_region_stats else None
+        self.output_file = output_file
+        self.flush_interval = flush_interval
+        self.logger = logger
+        self.manifest = manifest
+        self.file_signatures = file_signatures
+        self.rules_digest = rules_digest
+        self.index = index
+        # Chunks and index rows of split regions, until all of their tasks have finished
+        self.region_chunks = defaultdict(dict)
+        self.region_index_rows = defaultdict(list)
+        # Outstanding tasks of each region, and the share of its size each one covers
+        self.parts = Counter(task[0] for task in tasks)
+        self.region_sizes = dict((region_file, os.path.getsize(region_file)) for region_file in self.parts)
+        self.part_size = dict((region_file, self.region_sizes[region_file] / float(parts))
+                              for (region_file, parts) in self.parts.viewitems())
+        self.total_regions = len(self.parts)
+        self.total_bytes = sum(self.part_size[region_file] * parts
+                               for (region_file, parts) in self.parts.viewitems())
+        self.done_regions = 0
+        self.done_bytes = 0
+        self.start_time = time.time()
+        self.last_flush = self.start_time
+
+    def merge(self, region_file, data, key=None):
+        """Add one part of a CompactInventory to the world inventory, and that of its dimension"""
+        self.world_data.add(data, key)
+        if self.dimension_data is not None:
+            self.dimension_data[self.region_tags[region_file]].add(data, key)
+        if self.columns is not None:
+            (states, refs, counts) = data.parts[key]
+            signature_ids = np.full(len(refs), NO_SIGNATURE, dtype=np.int64)
+            tiled = refs != NO_SIGNATURE
+            signature_ids[tiled] = self.world_data.table_ids(data)[refs[tiled]]
+            self.columns.add(region_file, states, signature_ids, counts)
+
+    def update(self, region_file, inventory):
+        """Add an inventory Counter to the world inventory, and that of its dimension"""
+        self.world_data.update(inventory)
+        if self.dimension_data is not None:
+            self.dimension_data[self.region_tags[region_file]].update(inventory)
+        if self.columns is not None:
+            self.columns.add_inventory(region_file, inventory, self.world_data)
+
+    def add(self, task, data, stats, chunks=None, index_rows=None):
+        region_file = task[0]
+        self.merge(region_file, data)
+        self.stats.update(stats)
+        if self.region_stats is not None:
+            self.region_stats[region_file].update(stats)
+        if chunks is not None:
+            for (index, timestamp) in chunks.viewitems():
+                if index in data.parts:
+                    self.merge(region_file, data, index)
+                    inventory = self.world_data.expand(data, index)
+                else:
+                    # Unchanged, the manifest keeps the inventory it has
+                    self.update(region_file, self.manifest.chunk_inventory(region_file, index))
+                    inventory = None
+                self.region_chunks[region_file][index] = (timestamp, inventory)
+        if index_rows is not None:
+            self.region_index_rows[region_file].append(index_rows)
+        self.done_bytes += self.part_size[region_file]
+        self.parts[region_file] -= 1
+        if self.parts[region_file] == 0:
+            self.done_regions += 1
+            if self.manifest is not None:
+                self.manifest.update_region(region_file, self.file_signatures[region_file],
+                                            self.region_chunks.pop(region_file, {}))
+                if self.rules_digest is not None:
+                    self.manifest.mark_replaced(region_file, self.rules_digest)
+                    # Journaled straight away, so an interrupted run is never
+                    # resumed by applying the rules to this region again
+                    self.manifest.record(region_file)
+            if region_file in self.region_index_rows:
+                parts = self.region_index_rows.pop(region_file)
+                tiles = Counter()
+                for (_, part_tiles) in parts:
+                    tiles.update(part_tiles)
+                self.index.update_region(region_file, self.file_signatures[region_file],
+                                         np.concatenate([blocks for (blocks, _) in parts]), tiles)
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        world_data = self.world_data
+        if self.shared_counts is not None:
+            world_data = world_data.with_block_counts(self.shared_counts.block_totals())
+        write_block_data(world_data, self.output_file)
+        if self.dimension_data is not None:
+            dimension_data = self.dimension_data
+            if self.shared_counts is not None:
+                totals = self.shared_counts.totals()
+                dimension_data = dict((dimension, inventory.with_block_counts(
+                                          totals[self.shared_counts.dimensions.index(dimension)].sum(axis=0)))
+                                      for (dimension, inventory) in dimension_data.viewitems())
+            write_dimension_data(dimension_data, self.dimension_file)
+        if self.columns is not None:
+            # With shared counts, blocks without a tile entity are only known per
+            # dimension. Both number the dimensions of the same region_tags alike.
+            dimension_counts = None
+            if self.shared_counts is not None:
+                dimension_counts = self.shared_counts.totals().sum(axis=1)
+            temp_file = self.columns_file + ".tmp"
+            self.columns.save(temp_file, self.world_data.signatures, dimension_counts)
+            replace_file(temp_file, self.columns_file)
+        if self.manifest is not None:
+            self.manifest.save()
+        self.last_flush = time.time()
+        self.logger.info(self.progress())
+
+    def progress(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        message = "{}/{} regions done, {:.2f} regions/s".format(
+            self.done_regions, self.total_regions, self.done_regions / elapsed)
+        # Regions are processed largest first, so the ETA goes by bytes rather than region count
+        if 0 < self.done_bytes < self.total_bytes:
+            eta = elapsed * (self.total_bytes - self.done_bytes) / self.done_bytes
+            message += ", ETA {}".format(datetime.timedelta(seconds=int(eta)))
+        return message
+
+# Apply a single compiled rule to one block and its tile entity, if it has one
+# Changes are counted in changes, a Counter keyed by (kind, rule title),
+# see CHANGE_KINDS
+# Tile entity changes are recorded in journal, see TileJournal
+def process_block_change(rule,block,data,section_tiles,i,changes,journal,position):
+    (new_block, new_data) = rule.apply(block, data)
+    if (new_block, new_data) != (block, data):
+        changes[("blocks", rule.title)] += 1
+    tile = section_tiles.get(i)
+    if tile is None:
         # Block didn't have a tile entity attached
-        pass
-    return (block,data,tile,chunk_modified,tile_entity_modified)
+        return (new_block, new_data)
+    if rule.delete:
+        # If delete property specified, remove the tile entity
+        del section_tiles[i]
+        journal.delete(position)
+        changes[("tiles_deleted", rule.title)] += 1
+        return (new_block, new_data)
+    if rule.to_nbt is not None:
+        for tag,tag_data in rule.to_nbt.viewitems():
+            tile[tag] = pack_nbt(tag_data)
+        changes[("tags_edited", rule.title)] += len(rule.to_nbt)
+        journal.edit(position)
+    if rule.delete_nbt is not None:
+        for delTag in rule.delete_nbt:
+            if delTag in tile:
+                del tile[delTag]
+                changes[("tags_edited", rule.title)] += 1
+                journal.edit(position)
+    return (new_block, new_data)
+
+# Log the changes counted by process_block_change() and replace_section(),
+# a line per rule
+def log_changes(logger, level, prefix, changes):
+    titles = sorted(set(title for (_, title) in changes))
+    for title in titles:
+        logger.log(level, "%s%s: " + ", ".join(CHANGE_KINDS.viewvalues()), prefix, title,
+                   *[changes[(kind, title)] for kind in CHANGE_KINDS])
+
+# Apply the compiled rules to a single section, and its tile entities
+# Returns whether the blocks of the section were modified, tile entity
+# changes are recorded in journal
+def replace_section(rules,section,blocks,data,states,section_tiles,changes,journal):
+    # Blocks with a tile entity whose rules depend on it go through the slow path,
+    # the rules of every other block are applied to the whole section at once
+    tile_positions = [i for i in sorted(section_tiles) if rules.conditional[states[i]]]
+    section_y = section["Y"].value
+    (new_blocks, new_data) = rules.remap(states)
+    (changed_keys, changed_counts) = rules.changed_keys(states, exclude=tile_positions)
+    section_modified = len(changed_keys) > 0
+    for key,count in itertools.izip(changed_keys.tolist(), changed_counts.tolist()):
+        changes[("blocks", rules.rules[key][0].title)] += count
+    for i in tile_positions:
+        block_id = int(blocks[i])
+        block_data = int(data[i])
+        (base, matches) = rules.lookup(block_id, block_data)
+        (new_block, new_value) = (block_id, block_data)
+        # First succesful NBT match will be applied
+        for match in matches:
+            if match.matches(section_tiles.get(i)):
+                (new_block, new_value) = process_block_change(
+                    match, new_block, new_value, section_tiles, i, changes, journal, (section_y, i))
+                break
+        # As long as block ID and Data have matched apply this, WILL override NBT matches
+        (new_block, new_value) = process_block_change(
+            base, new_block, new_value, section_tiles, i, changes, journal, (section_y, i))
+        if (new_block, new_value) != (block_id, block_data):
+            section_modified = True
+        new_blocks[i] = new_block
+        new_data[i] = new_value
+    # If changes were made, update the section for writing back to file
+    if section_modified:
+        (section["Blocks"], section["Data"], add) = encode_section(new_blocks, new_data)
+        if add is not None:
+            section["Add"] = add
+        elif "Add" in section:
+            del section["Add"]
+    return section_modified
 
-def process_region(region_file):
-    replacements = process_region.replacements
-    region = nbt.region.RegionFile(region_file)
+# Move the counts of block_counts into an inventory Counter, and reset them
+def add_block_counts(inventory, block_counts):
+    present = np.flatnonzero(block_counts)
+    for state,count in itertools.izip(present.tolist(), block_counts[present].tolist()):
+        inventory[(state >> 4, state & 15, None, None)] += count
+    block_counts[present] = 0
+
+# Returns the region inventory, a Counter of statistics about the work done
+# (including the time spent in each phase, see timing.py),
+# and, for incremental runs, {chunk index: timestamp} of every chunk in the
+# region. The inventory is returned as a CompactInventory (see inventory.py),
+# with the region inventory under the key None. For incremental runs that
+# is left empty, and every chunk that was scanned has its own inventory
+# under its chunk index.
+# If chunk_rows is given only the chunks whose z coordinate within the region
+# is in the range [first, last) are processed.
+# Chunks whose timestamp matches the one in known_chunks are not read at
+# all, and are returned without an inventory.
+def process_region(region_file, chunk_rows=None, known_chunks=None, only_chunks=None):
+    stats = Counter()
+    timer = PhaseTimer(stats)
+    rules = process_region.rules
+    write_mode = process_region.options.write_mode
+    depth = process_region.options.pipeline_depth
+    compression_level = COMPRESSION_LEVELS[process_region.options.compression]
+    pool = process_region.decompress_pool
+    track_chunks = process_region.options.incremental
+    # Rows for the block index, see block_index.py
+    build_index = process_region.options.index is not None and rules is None
+    index_blocks = []
+    index_tiles = Counter()
+    reader = RegionReader(region_file)
+    # Only opened to write chunks back in place
+    regions = []
+    # Compressed chunk records, kept until the region is rewritten as a whole
+    modified_chunks = {}
+    # Runs on the writer thread, behind the processing of the chunks that follow.
+    # With a thread pool the chunk was handed to it to be compressed, and
+    # data is the AsyncResult of that
+    def store_chunk(index, data):
+        record = data.get() if pool is not None else compress_record(data, compression_level)
+        if write_mode == "region":
+            modified_chunks[index] = record
+        else:
+            if not regions:
+                regions.append(nbt.region.RegionFile(region_file))
+            write_record(regions[0], index, record)
+    writer = None
     # Iterate through chunks in this region file and process them
-    region_data = []
-    for chunk in region.iter_chunks():
-        level = chunk["Level"]
-        tile_data = defaultdict(lambda: defaultdict(dict))
-        chunk_modified = False
-        tile_entity_modified = False
-        for tile_entity in level["TileEntities"]:
-            x = tile_entity["x"].value
-            y = tile_entity["y"].value
-            z = tile_entity["z"].value
-            tile_data[x][y][z] = tile_entity
-        for ySec,section in enumerate(level["Sections"]):
-            blocks = list(unpack_nbt(section["Blocks"]))
-            data = array_4bit_to_byte(section["Data"])
+    region_data = Counter()
+    chunks = {} if track_chunks else None
+    # Occurrences of every block state, blocks with a tile entity are
+    # counted in the inventory instead
+    block_counts = np.zeros(BLOCK_STATES, dtype=np.int64)
+    # With shared counts they are added to this worker's slot instead, by
+    # dimension and Y band, see shared_counts.py
+    shared = process_region.shared_counts
+    if shared is not None:
+        dimension_counts = process_region.shared_slot[shared.dimension(region_file)]
+    target = process_region.options.target
+    signatures = {}
+    indexes = []
+    for index in reader.chunk_indexes():
+        if chunk_rows is not None and not (chunk_rows[0] <= index // 32 < chunk_rows[1]):
+            continue
+        if only_chunks is not None and index not in only_chunks:
+            continue
+        if known_chunks and known_chunks.get(index) == reader.timestamps[index]:
+            chunks[index] = (reader.timestamps[index], None)
+            stats["chunks_cached"] += 1
+            continue
+        indexes.append(index)
+    timer.lap("read")
+    # Chunks are decompressed ahead by the thread pool, while earlier ones are
+    # scanned, and modified chunks are written behind them by the ChunkWriter
+    try:
+        for (index, chunk_data) in reader.iter_chunks(indexes, pool, depth):
+            timer.lap("read")
+            (x, z) = (index % 32, index // 32)
+            if chunk_data is None:
+                continue
+            stats["bytes_decompressed"] += len(chunk_data)
+            # The chunk is only read selectively here, see nbt_reader.py. It is
+            # parsed in full once it turns out to need replacements.
             try:
-                add = array_4bit_to_byte(section['Add'])
-                # If add exists, then lets update the block values as necessary 
-                for i,v in enumerate(add):
-                    blocks[i] = (blocks[i] + 256*v)
-            except (KeyError, AttributeError):
-                pass
-            for i,v in enumerate(blocks):
-                y = i // 256
-                z = (i - (y*256)) // 16
-                x = (i - (y*256) - (z*16))
-                y += ySec*16
-                z += level["zPos"].value*16
-                x += level["xPos"].value*16
-                try:
-                    id = tile_data[x][y][z]['id']
-                    stripped_tags =unpack_nbt(tile_data[x][y][z])
-                    for tag in tags_to_strip:
-                        stripped_tags.pop(tag,None)
-                    stripped_tags = json.dumps(stripped_tags, default=to_json)
-                    block = (blocks[i], data[i], id, stripped_tags)
-                except KeyError:
-                    block = (blocks[i], data[i], None, None)
-                try:
-                    region_data.index(block)
-                    # We've already seen this exact block
-                except ValueError:
-                    region_data.append(block)
-                try:
-                    # If no replacements file was passed in, don't try replacing blocks
-                    replacements
-                    if str(blocks[i]) in replacements:
-                        # Block ID matched, lets check data
-                        block_id = str(blocks[i])
-                        # Match Data value, or match always if wildcard present,
-                        if (str(data[i]) in replacements[block_id]):
-                            block_data = str(data[i])
-                        elif ("*" in replacements[block_id]):
-                            block_data = unicode("*")
-                        else:
-                            block_data = ""
-                        if block_data != "":
-                            title = None
-                            # Iterate through any declared NBT matches, first succesful match will be applied
-                            for key,value in replacements[block_id][block_data].viewitems():
-                                matched = True
-                                if key == "toID" or key == "toData":
-                                    break
-                                elif key == "title" or key == "delete" or key == "deleteNBT":
-                                    continue
-                                if "fromNBT" in value and ( x in tile_data and y in tile_data[x] and z in tile_data[x][y]):
-                                    # Pattern definitely given
-                                    for tag,tag_data in value['fromNBT'].viewitems():
-                                        # Check for tag, data pair in the tile-data
-                                        if tag in tile_data[x][y][z]:
-                                            if (tile_data[x][y][z][tag].value != tag_data):
-                                                matched = False
-                                                break
-                                        else:
-                                            matched = False
-                                            break
-                                if matched:
-                                    try:
-                                        title = replacements[block_id][block_data][key]["title"]
-                                    except:
-                                        title = key
-                                    (blocks[i],data[i],tile_data[x][y],
-                                    chunk_modified,tile_entity_modified) = process_block_change(
-                                        title,blocks[i],data[i],tile_data[x][y],z,
-                                        value,
-                                        chunk_modified,tile_entity_modified)
-                                    if "toNBT" in value:
-                                        chunk_modified = True
-                                        tile_entity_modified = True
-                                        # this pattern matched, lets make the changes specified, and be on our merry way
-                                        for tag,tag_data in value["toNBT"].viewitems():
-                                            tile_data[x][y][z][tag] = pack_nbt(tag_data)
-                                        process_region.logger.debug("Changing NBT-NBT: %s", title)
-                                    if "deleteNBT" in value:
-                                        for delTag in value["deleteNBT"]:
-                                            try:
-                                                if tile_data[x][y][z].pop(delTag,None) != None:
-                                                    process_region.logger.debug("Deleted Tag %s from %s", delTag, title)
-                                                    chunk_modified = True
-                                                    tile_entity_modified = True
-                                            except:
-                                                pass
-                            if not title:
-                                try:
-                                    title = replacements[block_id][block_data]["title"]
-                                except:
-                                    title = "{}:{}".format(block_id, block_data)
-                            # As long as block ID and Data have matched try this, WILL override NBT matches
-                            (blocks[i],data[i],tile_data[x][y],
-                            chunk_modified,tile_entity_modified) = process_block_change(
-                                title,blocks[i],data[i],tile_data[x][y],z,
-                                replacements[block_id][block_data],
-                                chunk_modified,tile_entity_modified)
-                except NameError:
-                    pass
-                # If changes were made, update level variable for writing back to file
-            if chunk_modified:
-                (level["Sections"][ySec]["Blocks"],
-                 level["Sections"][ySec]["Data"],
-                 level["Sections"][ySec]["Add"]) = parse_block_info(blocks, data)
-            # Flatten tile_data into tile_entities compound tag
-            if tile_entity_modified:
-                level["TileEntities"] = flatten_tile_entity(tile_data)
-        try:
-            replacements
-            if chunk_modified:
-                # Write out updated chunk
-                process_region.logger.info("Writing chunk data %d,%d to %s",level["xPos"].value%32, level["zPos"].value%32, region_file)
-                # Ensure that we don't interrupt a chunk write with SigInt.
-                with DelayedKeyboardInterrupt():
-                    region.write_chunk(level["xPos"].value%32, level["zPos"].value%32, chunk)                
-        except NameError as e:
-            print("Error finding: {0}".format(e))
-            pass
-        try:
-            del tile_entities
-            del level
-        except:
-            pass
-    return region_data
-
-def process_init(q,Replace):
-    process_region.replacements = Replace
-    process_region.qh = QueueHandler(q)
+                level = read_chunk(chunk_data)["Level"]
+            except (MalformedFileError, KeyError) as e:
+                stats["chunks_malformed"] += 1
+                process_region.logger.warning("Skipping chunk %d,%d of %s, it could not be read: %s",
+                                              x, z, region_file, e)
+                timer.lap("parse")
+                continue
+            inventory = Counter() if track_chunks else region_data
+            chunk_pos = (level["xPos"], level["zPos"])
+            tiles = index_tile_values(level)
+            stats["chunks"] += 1
+            timer.lap("parse")
+            # Sections holding at least one block with a replacement rule
+            matched_sections = []
+            for section in level.get("Sections", ()):
+                ySec = section["Y"]
+                if not target.contains_section(ySec):
+                    stats["sections_outside_target"] += 1
+                    continue
+                (blocks, data) = decode_arrays(section["Blocks"], section["Data"], section.get("Add"))
+                states = block_states(blocks, data)
+                section_counts = block_counts if shared is None else dimension_counts[shared.band(ySec)]
+                section_counts += np.bincount(states, minlength=BLOCK_STATES)
+                stats["sections"] += 1
+                if build_index:
+                    (keys, counts) = np.unique(states, return_counts=True)
+                    rows = np.empty((len(keys), 5), dtype=np.int64)
+                    rows[:] = chunk_pos + (ySec, 0, 0)
+                    rows[:, 3] = keys
+                    rows[:, 4] = counts
+                    index_blocks.append(rows)
+                # Only the positions with a tile entity need to be visited one by one
+                section_tiles = tiles.get(ySec, {})
+                for i,tile in section_tiles.viewitems():
+                    tile_id = tile["id"]
+                    block = (int(blocks[i]), int(data[i]), tile_id, tile_signature(tile, signatures))
+                    inventory[block] += 1
+                    section_counts[states[i]] -= 1
+                    if build_index:
+                        index_tiles[chunk_pos + (ySec, int(states[i])) + block[2:]] += 1
+                timer.lap("scan")
+                # If no replacements file was passed in, don't try replacing blocks
+                if rules is None:
+                    continue
+                if rules.matches_section(states):
+                    matched_sections.append((ySec, blocks, data, states))
+                else:
+                    stats["sections_skipped"] += 1
+                timer.lap("match")
+            if track_chunks:
+                add_block_counts(inventory, block_counts)
+                chunks[index] = (reader.timestamps[index], inventory)
+                timer.lap("scan")
+            if not matched_sections:
+                if rules is not None:
+                    stats["chunks_skipped"] += 1
+                continue
+            chunk = NBTFile(buffer=BytesIO(chunk_data))
+            level = chunk["Level"]
+            sections = dict((section["Y"].value, section) for section in level["Sections"])
+            tiles = index_tile_entities(level)
+            timer.lap("full_parse")
+            chunk_modified = False
+            journal = TileJournal()
+            changes = Counter()
+            for (ySec, blocks, data, states) in matched_sections:
+                chunk_modified |= replace_section(rules, sections[ySec], blocks, data, states,
+                                                  tiles.get(ySec, {}), changes, journal)
+            # Tile entity changes are applied to the list once for the chunk
+            if journal:
+                chunk_modified = True
+                journal.apply(level["TileEntities"])
+            stats.update(changes)
+            if changes and process_region.logger.isEnabledFor(logging.DEBUG):
+                log_changes(process_region.logger, logging.DEBUG,
+                            "Chunk %d,%d of %s, " % (x, z, region_file), changes)
+            timer.lap("replace")
+            if not chunk_modified:
+                del level
+                continue
+            new_data = serialize_chunk(chunk)
+            del level, chunk
+            timer.lap("compress")
+            # Rules that map blocks to what they already are leave the chunk as
+            # it was, it is not worth compressing and writing it back then
+            if new_data == chunk_data:
+                stats["chunks_unchanged"] += 1
+                continue
+            stats["chunks_written"] += 1
+            if write_mode != "region":
+                process_region.logger.info("Writing chunk data %d,%d to %s", x, z, region_file)
+            if writer is None:
+                writer = ChunkWriter(store_chunk, depth)
+            # zlib releases the GIL, so the pool compresses the chunk while
+            # the next ones are scanned
+            if pool is not None:
+                new_data = pool.apply_async(compress_record, (new_data, compression_level))
+            # Waits when the writer has fallen depth chunks behind
+            writer.put(index, new_data)
+            timer.lap("write")
+    finally:
+        # SIGINT only interrupts this thread, so the writer still finishes
+        # the chunks it was given, rather than leaving one half written
+        if writer is not None:
+            writer.close()
+    stats[("seconds", "decompress")] += reader.read_seconds
+    if pool is None:
+        # Chunks were then decompressed as they were read, in the read laps
+        stats[("seconds", "read")] -= reader.read_seconds
+    reader.close()
+    if writer is not None:
+        stats[("seconds", "compress" if write_mode == "region" else "write")] += writer.seconds
+        stats["bytes_compressed"] += sum(len(record) for record in modified_chunks.viewvalues())
+    timer.lap("write")
+    for region in regions:
+        region.close()
+    if modified_chunks:
+        process_region.logger.info("Rewriting %s with %d modified chunks", region_file, len(modified_chunks))
+        with DelayedKeyboardInterrupt():
+            rewrite_region(region_file, modified_chunks)
+        timer.lap("write")
+    add_block_counts(region_data, block_counts)
+    if build_index:
+        index_rows = (np.concatenate(index_blocks) if index_blocks else
+                      np.empty((0, 5), dtype=np.int64), index_tiles)
+    else:
+        index_rows = None
+    inventories = {None: region_data}
+    if track_chunks:
+        for (index, (timestamp, inventory)) in chunks.viewitems():
+            if inventory is not None:
+                inventories[index] = inventory
+            chunks[index] = timestamp
+    region_data = CompactInventory(inventories)
+    timer.lap("scan")
+    timer.stop()
+    return (region_data, stats, chunks, index_rows)
+
+# Pool entry point, returns the task along with its result
+# When profiling, the stats of the worker so far are dumped after every task,
+# as pool workers are not told when they are about to exit
+def process_task(task):
+    profiler = process_region.profiler
+    if profiler is not None:
+        profiler.enable()
+    try:
+        return (task, process_region(*task))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(process_region.profile_folder, "%d.prof" % os.getpid()))
+        process_region.qh.flush()
+
+# Build the list of (region file, chunk rows, known chunks, only chunks) tasks. Regions
+# are ordered largest first by size on disk, so a huge region does not end up
+# running alone at the end. Regions bigger than split_size bytes are split
+# into bands of chunk rows that run as separate tasks.
+# known_chunks maps region files to {chunk index: timestamp} of the chunks
+# that do not need to be scanned again, if they are unchanged.
+# only_chunks maps region files to the set of chunk indexes to open, all
+# other chunks of those regions are left alone.
+def schedule_tasks(region_files, split_size=None, known_chunks={}, only_chunks={}):
+    tasks = []
+    for region_file in region_files:
+        size = os.path.getsize(region_file)
+        known = known_chunks.get(region_file)
+        only = only_chunks.get(region_file)
+        if split_size and size > split_size:
+            parts = min(32, -(-size // split_size))
+            bounds = [32 * i // parts for i in range(parts + 1)]
+            for i in range(parts):
+                tasks.append((size // parts, (region_file, (bounds[i], bounds[i+1]), known, only)))
+        else:
+            tasks.append((size, (region_file, None, known, only)))
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [task for (_, task) in tasks]
+
+def process_init(q,rules,options,profile_folder=None,shared_counts=None):
+    process_region.rules = rules
+    process_region.options = options
+    process_region.shared_counts = shared_counts
+    process_region.shared_slot = shared_counts.claim_slot() if shared_counts is not None else None
+    process_region.profile_folder = profile_folder
+    process_region.profiler = cProfile.Profile() if profile_folder is not None else None
+    if options.decompress_threads > 0:
+        process_region.decompress_pool = ThreadPool(options.decompress_threads)
+    else:
+        process_region.decompress_pool = None
+    process_region.qh = BatchQueueHandler(q)
     process_region.logger = logging.getLogger(__name__)
-    process_region.logger.setLevel(logging.DEBUG)
-    process_region.logger.addHandler(process_region.qh)
+    # Only log what the parent is going to write out, and drop the handlers
+    # inherited from it, or every record would be written twice
+    process_region.logger.setLevel(min(logging.getLevelName(options.log_level), logging.INFO))
+    process_region.logger.handlers = [process_region.qh]
     
 def logger_thread(q):
     logger = logging.getLogger(__name__)
     while True:
-        record = q.get()
-        if record is None:
+        records = q.get()
+        if records is None:
             break
-        logger.handle(record)
+        # Workers send their records in batches
+        if not isinstance(records, list):
+            records = [records]
+        for record in records:
+            logger.handle(record)
 
-def configure_logging():
+def configure_logging(level=logging.DEBUG):
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(min(level, logging.INFO))
     fh = logging.FileHandler(os.path.join(os.getcwd(), "replacements.log"))
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     fh.setFormatter(formatter)
-    fh.setLevel(logging.DEBUG)
+    fh.setLevel(level)
     ch = logging.StreamHandler()
     ch.setFormatter(formatter)
     ch.setLevel(logging.INFO)
@@ -277,62 +688,337 @@ def configure_logging():
     logger.addHandler(ch)
     return logger
     
-def main(world_folder, replacement_file_name):
-    global replacements
-    world = nbt.world.WorldFolder(world_folder)
-    logger = configure_logging()
-    logger.info("Starting processing of %s", world_folder)
-    if not isinstance(world, nbt.world.AnvilWorldFolder):
-        logger.error("%s is not an Anvil world" % (world_folder))
-        return 65 # EX_DATAERR
+# Return (dimension, region file) of the region files of a world. With
+# all_dimensions those in the DIM folders are included too, the Nether, the
+# End and mod dimensions, named after their folder.
+def world_region_files(world, all_dimensions=False):
+    region_files = [("overworld", region_file) for region_file in world.get_regionfiles()]
+    if all_dimensions:
+        for region_folder in sorted(glob.glob(os.path.join(world.worldfolder, "DIM*", "region"))):
+            dimension = os.path.basename(os.path.dirname(region_folder))
+            region_files.extend((dimension, region_file) for region_file in
+                                glob.glob(os.path.join(region_folder, "r.*.*." + world.extension)))
+    return region_files
+
+# Every world is processed in a single pool, with its regions tagged by
+# dimension. Dimension names get the world folder in front of them when
+# there are several worlds.
+def main(world_folders, replacement_file_name, options):
+    logger = configure_logging(logging.getLevelName(options.log_level))
+    region_files = []
+    region_tags = {}
+    for world_folder in world_folders:
+        world = nbt.world.WorldFolder(world_folder)
+        logger.info("Starting processing of %s", world_folder)
+        if not isinstance(world, nbt.world.AnvilWorldFolder):
+            logger.error("%s is not an Anvil world" % (world_folder))
+            return 65 # EX_DATAERR
+        for (dimension, region_file) in world_region_files(world, options.all_dimensions):
+            region_tags[region_file] = (dimension if len(world_folders) == 1 else
+                                        os.path.join(world_folder, dimension))
+            region_files.append(region_file)
+    dimensions = Counter(region_tags.viewvalues())
+    for dimension in sorted(dimensions):
+        logger.info("Found %d region files in %s", dimensions[dimension], dimension)
+    only_chunks = {}
+    target = options.target
+    if target.limits_chunks():
+        # Regions outside the target are dropped by name, and only the chunks
+        # inside it are opened in the others, see targeting.py
+        for region_file in region_files:
+            only_chunks[region_file] = target.region_chunks(region_file)
+        region_files = [region_file for region_file in region_files if only_chunks[region_file]]
+        logger.info("Target covers %d chunks in %d regions",
+                    sum(len(chunks) for chunks in only_chunks.viewvalues()), len(region_files))
+        only_chunks = dict((region_file, only_chunks[region_file]) for region_file in region_files)
     if replacement_file_name != None:
         logger.info("Using Replacements file: %s", replacement_file_name)
-        with open(replacement_file_name, 'r') as replacement_file:
-            replacements = json.load(replacement_file)
-    # get list of region files, going to pass this into function to process region
-    region_files = world.get_regionfiles()
+        rules = load_rules(replacement_file_name)
+        logger.info("Compiled replacements for %d block ID:Data pairs", len(rules))
+    else:
+        rules = None
+    file_signatures = dict((region_file, file_signature(region_file)) for region_file in region_files)
+    # Regions whose inventory is taken from the manifest as a whole
+    cached_regions = []
+    known_chunks = {}
+    index = None
+    if options.index is not None:
+        index = BlockIndex(options.index, tags_to_strip)
+        if rules is None:
+            index.retain(region_files)
+    manifest = None
+    digest = None
+    if options.incremental:
+        manifest = Manifest(MANIFEST_FILE, tags_to_strip)
+        manifest.retain(region_files)
+        if rules is not None:
+            # Resume a replacement run, skipping the regions it already finished
+            digest = rules_digest(replacement_file_name)
+            cached_regions = [region_file for region_file in region_files
+                              if manifest.is_replaced(region_file, digest, file_signatures[region_file])]
+        else:
+            for region_file in region_files:
+                if index is not None and not index.is_current(region_file, file_signatures[region_file]):
+                    # Scanned in full, so its index entry is complete
+                    continue
+                if manifest.is_unchanged(region_file, file_signatures[region_file]):
+                    cached_regions.append(region_file)
+                elif index is None:
+                    known_chunks[region_file] = manifest.chunk_timestamps(region_file)
+                # Otherwise it is scanned in full as well, as its index entry is
+                # replaced by the rows of the chunks that are scanned
+        logger.info("Taking %d of %d regions from the manifest", len(cached_regions), len(region_files))
+        region_files = sorted(set(region_files) - set(cached_regions))
+    if index is not None and rules is not None:
+        # Only open the chunks the index says hold a block some rule could change
+        active_states = np.flatnonzero(rules.active)
+        indexed_regions = [region_file for region_file in region_files
+                           if index.is_current(region_file, file_signatures[region_file])]
+        for region_file in indexed_regions:
+            only_chunks[region_file] = index.chunks_with(region_file, active_states)
+        logger.info("Index limits %d of %d regions to %d chunks", len(indexed_regions),
+                    len(region_files), sum(len(chunks) for chunks in only_chunks.viewvalues()))
+        region_files = [region_file for region_file in region_files
+                        if only_chunks.get(region_file, True)]
+    split_size = int(options.split_size * 1024 * 1024) if options.split_size else None
+    if split_size and rules is not None:
+        # Several workers writing into the same region file would corrupt it
+        logger.info("Not splitting regions, replacements are being made")
+        split_size = None
+    tasks = schedule_tasks(region_files, split_size, known_chunks, only_chunks)
+    workers = options.workers or cpu_count()
+    logger.info("Processing %d region files as %d tasks with %d workers",
+                len(region_files), len(tasks), workers)
+    
+    shared_counts = None
+    if options.shared_counts:
+        shared_counts = SharedCounts(workers, region_tags, options.band_height)
+    # Inventories per dimension are only worth writing out if there are several
+    tag_results = len(dimensions) > 1
+    aggregator = ResultAggregator(tasks, OUTPUT_FILE, options.flush_interval, logger,
+                                  manifest, file_signatures, digest, index,
+                                  keep_region_stats=options.timing_report is not None,
+                                  shared_counts=shared_counts,
+                                  region_tags=region_tags if tag_results else None,
+                                  dimension_file=DIMENSIONS_FILE,
+                                  columns=InventoryColumns(region_tags) if options.columnar_output else None,
+                                  columns_file=INVENTORY_FILE)
+    for region_file in cached_regions:
+        aggregator.update(region_file, manifest.region_inventory(region_file))
+    # The chunks the index kept out of the replacement are inventoried from it
+    if index is not None:
+        for (region_file, chunks) in only_chunks.viewitems():
+            aggregator.update(region_file, index.region_inventory(region_file, exclude=chunks))
     
     # Parallel
+    profile_folder = tempfile.mkdtemp(prefix="profile.") if options.profile else None
     q = Queue()
     lp = threading.Thread(target=logger_thread, args=[q])
     lp.start()
-    p = Pool(processes=4,initializer=process_init, initargs=[q,replacements], maxtasksperchild=1)
-    region_data = p.map(process_region, region_files)
-    # Map has finished up, lets close the logging QUEUE
-    q.put(None)
-    lp.join()
+    p = Pool(processes=workers,initializer=process_init, initargs=[q,rules,options,profile_folder,shared_counts])
+    try:
+        for (task, (data, region_stats, chunks, index_rows)) in p.imap_unordered(process_task, tasks):
+            aggregator.add(task, data, region_stats, chunks, index_rows)
+        p.close()
+    except:
+        p.terminate()
+        # Keep the regions that did finish, see ResultAggregator.add()
+        if manifest is not None:
+            manifest.save()
+        raise
+    finally:
+        p.join()
+        # All tasks have finished up, lets close the logging QUEUE
+        q.put(None)
+        lp.join()
+        if profile_folder is not None:
+            logger.info("Merged the profiles of %d workers into %s",
+                        merge_profiles(profile_folder, options.profile), options.profile)
+            shutil.rmtree(profile_folder)
     
     # Not Parallel
-#     region_data = map(process_region, region_files)
+#     for (task, (data, region_stats, chunks, index_rows)) in itertools.imap(process_task, tasks):
+#         aggregator.add(task, data, region_stats, chunks, index_rows)
+    
+    stats = aggregator.stats
+    if stats["chunks_malformed"]:
+        logger.warning("Skipped %d chunks that could not be read, they are missing from the inventory",
+                       stats["chunks_malformed"])
+    if manifest is not None:
+        logger.info("Scanned %d changed chunks, took %d unchanged chunks from the manifest",
+                    stats["chunks"], stats["chunks_cached"])
+    if rules is not None:
+        logger.info("Pre-filter skipped %d of %d sections and %d of %d chunks, wrote %d chunks, "
+                    "left %d chunks the rules did not change", stats["sections_skipped"], stats["sections"],
+                    stats["chunks_skipped"], stats["chunks"], stats["chunks_written"], stats["chunks_unchanged"])
+        log_changes(logger, logging.INFO, "Total for ",
+                    Counter(dict((key, count) for (key, count) in stats.viewitems()
+                                 if isinstance(key, tuple) and key[0] in CHANGE_KINDS)))
+    logger.info("Time per phase: %s", format_phases(stats))
+    if options.timing_report is not None:
+        outliers = write_report(options.timing_report, stats, aggregator.region_stats,
+                                aggregator.region_sizes, time.time() - aggregator.start_time)
+        logger.info("Wrote timing report to %s", options.timing_report)
+        for region in outliers:
+            logger.info("Slow region %s: %.2f s, %.2f s/MB", region["region"],
+                        region["seconds"], region["seconds_per_mb"])
     
     # Write output data
-    write_block_data(region_data,"output.txt")
+    aggregator.flush()
+    if shared_counts is not None:
+        shared_counts.save(COUNTS_FILE)
+        logger.info("Wrote block counts of %d dimensions in %d bands to %s",
+                    len(shared_counts.dimensions), shared_counts.bands, COUNTS_FILE)
+    if index is not None:
+        index.close()
     return 0
 
+class UsageArgumentParser(argparse.ArgumentParser):
+    # Exit with EX_USAGE, rather than the argparse default of 2
+    def error(self, message):
+        usage(message)
+        sys.exit(64) # EX_USAGE
+
+def argument_parser():
+    parser = UsageArgumentParser(description="Inventory, and optionally replace, the blocks of an Anvil world.")
+    parser.add_argument("world_folder", metavar="WORLD_FOLDER")
+    parser.add_argument("replacement_file_name", metavar="REPLACEMENT_FILE", nargs="?")
+    parser.add_argument("--write-mode", choices=["chunk", "region"], default="chunk",
+                        help="chunk: write each modified chunk in place (default). "
+                        "region: rewrite each modified region file in one sequential pass, "
+                        "and swap it in with an atomic rename")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--decompress-threads", type=int, default=2, metavar="N",
+                        help="threads per worker decompressing chunks ahead of the scan, and "
+                        "compressing modified chunks behind it. 0 decompresses them in the scan "
+                        "itself, and compresses them on the writer thread (default 2)")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_LEVELS), default="default",
+                        help="zlib level of the modified chunks, fast (1), default (the level "
+                        "Minecraft uses) or max (9)")
+    parser.add_argument("--pipeline-depth", type=int, default=16, metavar="N",
+                        help="chunks each worker may decompress ahead of the scan, and modified "
+                        "chunks it may queue for its writer thread behind it (default 16)")
+    parser.add_argument("--split-size", type=float, default=None, metavar="MB",
+                        help="split region files larger than this into bands of chunk rows, "
+                        "processed as separate tasks. Only used when no replacements are made")
+    parser.add_argument("--flush-interval", type=float, default=60, metavar="SECONDS",
+                        help="write the inventory gathered so far to output.txt, and report "
+                        "progress, this often (default 60)")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING"], default="DEBUG",
+                        help="level of the messages written to replacements.log. DEBUG (the default) "
+                        "adds a line per chunk and rule with the number of changes made")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep a manifest of region and chunk timestamps next to output.txt, "
+                        "and only scan the chunks that changed since the last run. With a "
+                        "replacements file, resume an interrupted run with the same rules, "
+                        "skipping the regions it already finished")
+    parser.add_argument("--index", metavar="INDEX_FILE",
+                        help="without a replacements file, record where every block is in this "
+                        "SQLite file (see block_index.py). With one, only open the chunks the "
+                        "index says hold a block that could be replaced")
+    parser.add_argument("--timing-report", metavar="REPORT_FILE",
+                        help="write the time spent in each phase, in total and per region, to this "
+                        "JSON file. Regions that were unusually slow for their size are flagged")
+    parser.add_argument("--profile", metavar="PROFILE_FILE",
+                        help="run cProfile in every worker process, and merge their stats into "
+                        "this file, to be read with pstats")
+    parser.add_argument("--shared-counts", action="store_true",
+                        help="count blocks without a tile entity in shared memory, rather than "
+                        "returning them from every region, and also write them to %s by "
+                        "dimension and Y band" % COUNTS_FILE)
+    parser.add_argument("--band-height", type=int, default=256, metavar="BLOCKS",
+                        help="height of the Y bands of --shared-counts, a multiple of 16 (default "
+                        "256, a single band)")
+    parser.add_argument("--world", action="append", default=[], metavar="WORLD_FOLDER",
+                        dest="extra_worlds",
+                        help="another world to process in the same run, may be repeated. The "
+                        "inventory of each dimension is also written to %s" % DIMENSIONS_FILE)
+    parser.add_argument("--columnar-output", action="store_true",
+                        help="also write the inventory of every region to %s, a columnar file "
+                        "with the tile entity signatures in a table of their own, that "
+                        "inventory_file.InventoryFile reads lazily" % INVENTORY_FILE)
+    parser.add_argument("--all-dimensions", action="store_true",
+                        help="also process the DIM folders of each world, such as DIM-1 (the "
+                        "Nether), DIM1 (the End) and those of mods")
+    target = parser.add_argument_group("target", "Only process part of the world. Regions and chunks "
+                                       "outside the target are never opened. When several of these "
+                                       "are given, only what is inside all of them is processed")
+    target.add_argument("--box", nargs=4, type=int, metavar=("MIN-X", "MIN-Z", "MAX-X", "MAX-Z"),
+                        help="a box of chunk coordinates, inclusive")
+    target.add_argument("--block-box", nargs=4, type=int, metavar=("MIN-X", "MIN-Z", "MAX-X", "MAX-Z"),
+                        help="a box of block coordinates, inclusive, widened to whole chunks")
+    target.add_argument("--radius", nargs=3, type=int, metavar=("X", "Z", "BLOCKS"),
+                        help="the chunks with a block within BLOCKS of block X,Z")
+    target.add_argument("--chunk-list", metavar="CHUNK_FILE",
+                        help="a file listing chunk coordinates, one X Z pair per line")
+    target.add_argument("--y-range", nargs=2, type=int, metavar=("MIN-Y", "MAX-Y"),
+                        help="only the sections holding a Y level in this range, inclusive")
+    # Replaced by one built from the options above, once they are checked
+    parser.set_defaults(target=Target())
+    return parser
+
 def usage(message=None, appname=None):
-    if appname == None:
-        appname = os.path.basename(sys.argv[0])
-    print("Usage: %s WORLD_FOLDER [REPLACEMENT_FILE]" % appname)
+    parser = argument_parser()
+    if appname != None:
+        parser.prog = appname
+    parser.print_usage()
     if message:
-        print("%s: error: %s" % (appname, message))
+        print("%s: error: %s" % (parser.prog, message))
 
 if __name__ == '__main__':
-    if (len(sys.argv) < 2) or (len(sys.argv) > 3):
-        usage()
+    options = argument_parser().parse_args()
+    replacement_file_name = options.replacement_file_name
+    if replacement_file_name != None and (not os.path.exists(replacement_file_name)):
+        usage("Replacements file ({}) does not exist".format(replacement_file_name))
+        sys.exit(72) # EX_IOERR
+    
+    world_folders = []
+    for world_folder in [options.world_folder] + options.extra_worlds:
+        # clean path name, eliminate trailing slashes:
+        world_folder = os.path.normpath(world_folder)
+        if (not os.path.exists(world_folder)):
+            usage("No such folder as "+world_folder)
+            sys.exit(72) # EX_IOERR
+        if world_folder not in world_folders:
+            world_folders.append(world_folder)
+    
+    if options.index is not None and options.incremental and replacement_file_name != None:
+        usage("--index can not be combined with --incremental when making replacements")
+        sys.exit(64) # EX_USAGE
+    
+    if options.shared_counts and (options.incremental or options.index is not None):
+        usage("--shared-counts can not be combined with --incremental or --index")
+        sys.exit(64) # EX_USAGE
+    
+    if options.band_height % 16 or not 0 < options.band_height <= 256:
+        usage("--band-height must be a multiple of 16, up to 256")
         sys.exit(64) # EX_USAGE
-    world_folder = sys.argv[1]
-    if (len(sys.argv) == 3):
-        replacement_file_name = sys.argv[2]
-        if (not os.path.exists(replacement_file_name)):
-            usage("Replacements file ({}) does not exist".format(world_folder))
+    
+    if options.pipeline_depth < 1:
+        usage("--pipeline-depth must be at least 1")
+        sys.exit(64) # EX_USAGE
+    
+    chunk_list = None
+    if options.chunk_list is not None:
+        if not os.path.exists(options.chunk_list):
+            usage("Chunk list ({}) does not exist".format(options.chunk_list))
             sys.exit(72) # EX_IOERR
-    else:
-        replacement_file_name = None
+        try:
+            chunk_list = load_chunk_list(options.chunk_list)
+        except ValueError as e:
+            usage(str(e))
+            sys.exit(65) # EX_DATAERR
+    if options.radius is not None and options.radius[2] < 0:
+        usage("--radius must not be negative")
+        sys.exit(64) # EX_USAGE
+    options.target = Target(options.box, options.block_box, options.radius, chunk_list, options.y_range)
     
-    # clean path name, eliminate trailing slashes:
-    world_folder = os.path.normpath(world_folder)
-    if (not os.path.exists(world_folder)):
-        usage("No such folder as "+world_folder)
-        sys.exit(72) # EX_IOERR
+    # A partial scan would pass for a complete one in the manifest or index
+    targeted = options.target.limits_chunks() or options.y_range is not None
+    if targeted and (options.incremental or options.index is not None):
+        usage("--box, --block-box, --radius, --chunk-list and --y-range can not be combined "
+              "with --incremental or --index")
+        sys.exit(64) # EX_USAGE
     
-    sys.exit(main(world_folder, replacement_file_name))
+    sys.exit(main(world_folders, replacement_file_name, options))
@@ -2,10 +2,19 @@
 """
 Print the block ID and data for a layer in a Anvil chunk
 This supports regular blocks with ID 0-255 and non-standard blocks with ID 256-4095.
+
+Without chunk coordinates, count the ores in every layer of the whole world
+(or of a box of chunks) instead, using all CPUs. Both write the counts for
+the ores listed in the ores file (Examples/ores.json) to ores.csv.
 """
 import os, sys
 import itertools
 import csv
+import json
+import argparse
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+import numpy as np
 # local module
 try:
 	import nbt
@@ -16,7 +25,11 @@ except ImportError:
 		raise
 	sys.path.append(extrasearchpath)
 import nbt
+from utilities import decode_section, MAX_DATA, BLOCK_STATES
 
+ORES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Examples", "ores.json")
+# Minecraft worlds are 16 sections high
+WORLD_HEIGHT = 256
 
 def array_4bit_to_byte(array):
 	"""Convert a 2048-byte array of 4096 4-bit values to an array of 4096 1-byte values.
@@ -60,7 +73,7 @@ def chunklayer(blocks, data, add, yoffset):
 	blocks = blocks[yoffset*256:(yoffset+1)*256]
 	data = array_4bit_to_byte(data[yoffset*128:(yoffset+1)*128])
 	if add is not None:
-		add = 	(add[yoffset*128:(yoffset+1)*128])
+		add = array_4bit_to_byte(add[yoffset*128:(yoffset+1)*128])
 		for i,v in enumerate(add):
 			Allblocks[i] = (blocks[i] + 256*v)
 	else:
@@ -72,9 +85,14 @@ def chunklayer(blocks, data, add, yoffset):
 	print(Fullblock)
 	return Fullblock
 
-def process_ores(Blocks):
-	ores = ['14:0', '15:0', '16:0', '21:0', '56:0', '73:0', '129:0', '153:0', '458:0', '458:2', '458:3', '458:4', '790:0', '790:1', '790:2', '790:3', '790:4', 
-	'854:0', '1015:0', '1475:1', '1475:2', '1475:3', '1475:4', '1475:5', '1942:0', '1942:2', '1942:4', '1942:6', '1942:8', '1942:10', '1942:12', '2001:0', '2001:1', '2001:2', '2001:3', '2001:4', '2130:0', '2130:1', '2130:2', '3483:0']
+def load_ores(ore_file):
+	"""Load the ores to count, a JSON list of {"block": "ID:Data", "label": name}
+	objects. Returns the lists of blocks and of labels, in file order."""
+	with open(ore_file, 'r') as f:
+		ores = json.load(f)
+	return ([ore["block"] for ore in ores], [ore["label"] for ore in ores])
+
+def process_ores(Blocks, ores):
 	Chunk = []
 	
 	for i,row in enumerate(Blocks):
@@ -84,25 +102,139 @@ def process_ores(Blocks):
 			layer.append(row.count(ore))
 		Chunk.append(layer)
 	return Chunk
-		
-def get_section(world, chunkx, chunky, chunkz):
+
+def section_histogram(section):
+	"""Count every id:data pair in each layer of a section. Returns the unique
+	(layer * BLOCK_STATES + state) keys of the section and their counts."""
+	(blocks, data) = decode_section(section)
+	layers = section['Y'].value * 16 + (np.arange(4096) >> 8)
+	keys = layers * BLOCK_STATES + ((blocks.astype(np.int64) << 4) | data)
+	return np.unique(keys, return_counts=True)
+
+def merge_histograms(parts):
+	"""Sum a list of (keys, counts) histograms into one"""
+	parts = [part for part in parts if len(part[0])]
+	if not parts:
+		return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+	(keys, inverse) = np.unique(np.concatenate([part[0] for part in parts]), return_inverse=True)
+	counts = np.bincount(inverse, weights=np.concatenate([part[1] for part in parts]))
+	return (keys, counts.astype(np.int64))
+
+def in_box(x, z, box):
+	return box is None or (box[0] <= x <= box[2] and box[1] <= z <= box[3])
+
+def region_histogram(task):
+	"""Per layer histogram of a region file, only counting the chunks in box.
+	Returns (keys, counts, chunks counted)."""
+	(region_file, (regionx, regionz), box) = task
+	region = nbt.region.RegionFile(region_file)
+	parts = []
+	chunks = 0
+	for m in region.get_metadata():
+		if not in_box(regionx * 32 + m.x, regionz * 32 + m.z, box):
+			continue
+		try:
+			chunk = region.get_chunk(m.x, m.z)
+		except nbt.region.RegionFileFormatError:
+			continue
+		chunks += 1
+		for section in chunk['Level']['Sections']:
+			if 'Blocks' in section and 0 <= section['Y'].value < WORLD_HEIGHT // 16:
+				parts.append(section_histogram(section))
+		# Keep the number of arrays waiting to be merged small
+		if len(parts) > 256:
+			parts = [merge_histograms(parts)]
+	region.close()
+	(keys, counts) = merge_histograms(parts)
+	return (keys, counts, chunks)
+
+def ore_table(keys, counts, ores):
+	"""Turn a world histogram into ores.csv rows, a level followed by the
+	count of each ore in that layer. Rows go up to the highest layer of the
+	highest section holding any block."""
+	columns = np.full(BLOCK_STATES, -1, dtype=np.intp)
+	for (column, ore) in enumerate(ores):
+		(block_id, data) = ore.split(":")
+		columns[int(block_id) * MAX_DATA + int(data)] = column
+	layers = keys // BLOCK_STATES
+	ore_columns = columns[keys % BLOCK_STATES]
+	levels = (layers.max() // 16 + 1) * 16 if len(keys) else 0
+	table = np.zeros((levels, len(ores)), dtype=np.int64)
+	found = ore_columns >= 0
+	np.add.at(table, (layers[found], ore_columns[found]), counts[found])
+	return [[level] + row for (level, row) in enumerate(table.tolist())]
+
+def write_ores(Orecounts, labels):
+	with open('ores.csv', 'wb') as Ores:
+		Writer = csv.writer(Ores, quoting=csv.QUOTE_MINIMAL)
+		Writer.writerow(['Level'] + labels)
+		for row in Orecounts:
+			Writer.writerow(row)
+
+class ChunkCache(object):
+	"""Bounded LRU cache of parsed chunks, keyed by (chunk x, chunk z).
+	Each chunk is kept with a map from section Y to section, so a chunk is
+	only parsed once however many of its sections are asked for. Chunks that
+	do not exist are remembered as well."""
+	def __init__(self, world, size=64):
+		self.world = world
+		self.size = size
+		self.chunks = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, chunkx, chunkz):
+		"""Return (chunk, {section Y: section}), or raise InconceivedChunk"""
+		key = (chunkx, chunkz)
+		if key in self.chunks:
+			self.hits += 1
+			entry = self.chunks.pop(key)
+		else:
+			self.misses += 1
+			try:
+				chunk = self.world.get_nbt(chunkx, chunkz)
+				entry = (chunk, dict((section['Y'].value, section) for section in chunk['Level']['Sections']))
+			except nbt.region.InconceivedChunk:
+				entry = None
+			if len(self.chunks) >= self.size:
+				self.chunks.popitem(last=False) # Least recently used
+		self.chunks[key] = entry
+		if entry is None:
+			raise nbt.region.InconceivedChunk("Chunk not defined")
+		return entry
+
+	def get_section(self, chunkx, chunky, chunkz):
+		(chunk, sections) = self.get(chunkx, chunkz)
+		if chunky not in sections:
+			raise nbt.region.InconceivedChunk("Section not defined")
+		return sections[chunky]
+
+	def stats(self):
+		return {"hits": self.hits, "misses": self.misses, "cached": len(self.chunks), "size": self.size}
+
+def get_section(world, chunkx, chunky, chunkz, cache=None):
 	"""Given a world folder, return the requested section.
-	If it is not defined, raise InconceivedChunk."""
+	If it is not defined, raise InconceivedChunk.
+	With a ChunkCache the chunk is only parsed the first time it is asked for."""
+	if cache is not None:
+		return cache.get_section(chunkx, chunky, chunkz)
 	chunk = world.get_nbt(chunkx, chunkz) # may raise InconceivedChunk
 	for section in chunk['Level']['Sections']: # Go through each layer of region 
 		if section['Y'].value == chunky:	#No clue why i could get different values...
 			return section					#Appears to go up to value
 	raise nbt.region.InconceivedChunk("Section not defined")
 
-def main(world_folder, chunkx, chunkz):
+def main(world_folder, chunkx, chunkz, ore_file=ORES_FILE):
+	(ores, labels) = load_ores(ore_file)
 	world = nbt.world.WorldFolder(world_folder)
 	if not isinstance(world, nbt.world.AnvilWorldFolder):
 		print("%s is not an Anvil world" % (world_folder))
 		return 65 # EX_DATAERR
 	ChunkBlocks = [];
+	cache = ChunkCache(world)
 	for sector in range(0,5):
 		try:
-			section = get_section(world, chunkx, sector, chunkz)
+			section = get_section(world, chunkx, sector, chunkz, cache)
 			try:
 				blocks = section['Blocks'].value
 				data = section['Data'].value
@@ -122,40 +254,73 @@ def main(world_folder, chunkx, chunkz):
 		for y in range(16):
 			print(y)
 			ChunkBlocks.append(chunklayer(blocks, data, add, y))
-	Orecounts = process_ores(ChunkBlocks)
-	with open('ores.csv', 'wb') as Ores:
-		Writer = csv.writer(Ores, quoting=csv.QUOTE_MINIMAL)
-		Writer.writerow(['Level', 'Gold', 'Iron', 'Coal', 'Lapis Lazuli', 'Diamond', 'Redstone', 'Emerald', 'Nether Quartz', 'Sulfer', 'Dark Diamond', 'Dark Emerald', 'Dark Lapis Lazuli', 'Vinteum', 'Chimerite', 'Blue Topaz', 'Moonstone', 'Sunstone', 'Certus Quartz', 'Quantum', 'Cobalt', 'Ardite', 'Copper', 'Tin', 'Aluminium', 'Ruby', 'Peridot', 'Topaz', 'Tanzanite', 'Malachite', 'Sapphire', 'Copper', 'Tin', 'Silver', 'Lead', 'Ferrous', 'Ruby', 'Sapphire', 'Peridot', 'Uranium']) 
-		for row in Orecounts:
-			Writer.writerow(row)
+	print("Chunk cache: %(misses)d chunks parsed, %(hits)d hits" % cache.stats())
+	Orecounts = process_ores(ChunkBlocks, ores)
+	write_ores(Orecounts, labels)
 	#for i in 256:
 	#	write_row(i, Blocks, data)
-	Ores.close()
 	return 0 # NOERR
 
+def world_main(world_folder, box=None, ore_file=ORES_FILE, workers=None):
+	"""Count the ores in every layer of all chunks of the world, or the
+	chunks inside box (min x, min z, max x, max z chunk coordinates)."""
+	(ores, labels) = load_ores(ore_file)
+	world = nbt.world.WorldFolder(world_folder)
+	if not isinstance(world, nbt.world.AnvilWorldFolder):
+		print("%s is not an Anvil world" % (world_folder))
+		return 65 # EX_DATAERR
+	tasks = [(region_file, (x, z), box) for ((x, z), region_file) in world.regionfiles.items()
+			if box is None or (box[0] >> 5 <= x <= box[2] >> 5 and box[1] >> 5 <= z <= box[3] >> 5)]
+	# Largest regions first, so the pool does not end on a single big one
+	tasks.sort(key=lambda task: os.path.getsize(task[0]), reverse=True)
+	p = Pool(processes=workers or cpu_count())
+	try:
+		results = p.map(region_histogram, tasks, chunksize=1)
+		p.close()
+	except:
+		p.terminate()
+		raise
+	finally:
+		p.join()
+	(keys, counts) = merge_histograms([(keys, counts) for (keys, counts, _) in results])
+	print("Counted %d chunks in %d region files" % (sum(result[2] for result in results), len(tasks)))
+	write_ores(ore_table(keys, counts, ores), labels)
+	return 0 # NOERR
+
+
+class UsageArgumentParser(argparse.ArgumentParser):
+	# Exit with EX_USAGE, rather than the argparse default of 2
+	def error(self, message):
+		usage(message)
+		sys.exit(64) # EX_USAGE
+
+def argument_parser():
+	parser = UsageArgumentParser(description="Count the ores in each layer of a chunk, "
+			"or of the whole world when no chunk is given, and write them to ores.csv.")
+	parser.add_argument("world_folder", metavar="WORLD_FOLDER")
+	parser.add_argument("chunk", metavar="CHUNK-X CHUNK-Z", nargs="*", type=int)
+	parser.add_argument("--box", nargs=4, type=int, metavar=("MIN-X", "MIN-Z", "MAX-X", "MAX-Z"),
+			help="only count the chunks inside this box of chunk coordinates, inclusive")
+	parser.add_argument("--ores", default=ORES_FILE, metavar="ORES_FILE",
+			help="JSON list of the ores to count, defaults to Examples/ores.json")
+	parser.add_argument("--workers", type=int, default=None,
+			help="number of worker processes, defaults to the number of CPUs")
+	return parser
 
 def usage(message=None, appname=None):
-	if appname == None:
-		appname = os.path.basename(sys.argv[0])
-	print("Usage: %s WORLD_FOLDER CHUNK-X CHUNK-Z BLOCKHEIGHT-Y" % appname)
+	parser = argument_parser()
+	if appname != None:
+		parser.prog = appname
+	parser.print_usage()
 	if message:
-		print("%s: error: %s" % (appname, message))
+		print("%s: error: %s" % (parser.prog, message))
 
 if __name__ == '__main__':
-	if (len(sys.argv) != 4):
-		usage()
-		sys.exit(64) # EX_USAGE
-	world_folder = sys.argv[1]
-	try:
-		chunkx = int(sys.argv[2])
-	except ValueError:
-		usage('Chunk X-coordinate should be an integer')
-		sys.exit(64) # EX_USAGE
-	try:
-		chunkz = int(sys.argv[3])
-	except ValueError:
-		usage('Chunk Z-coordinate should be an integer')
+	options = argument_parser().parse_args()
+	if len(options.chunk) not in (0, 2):
+		usage('Give both chunk coordinates, or neither to count the whole world')
 		sys.exit(64) # EX_USAGE
+	world_folder = options.world_folder
 	
 	# clean path name, eliminate trailing slashes:
 	world_folder = os.path.normpath(world_folder)
@@ -163,4 +328,10 @@ if __name__ == '__main__':
 		usage("No such folder as "+world_folder)
 		sys.exit(72) # EX_IOERR
 	
-	sys.exit(main(world_folder, chunkx, chunkz))
+	if options.chunk:
+		(chunkx, chunkz) = options.chunk
+		sys.exit(main(world_folder, chunkx, chunkz, options.ores))
+	box = options.box
+	if box is not None:
+		box = (min(box[0], box[2]), min(box[1], box[3]), max(box[0], box[2]), max(box[1], box[3]))
+	sys.exit(world_main(world_folder, box, options.ores, options.workers))
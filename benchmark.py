@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Benchmark the analysis and replacement pipeline on a synthetic world.
+
+Micro benchmarks time the hot functions on their own: the nibble converters
+in utilities.py, section decoding and encoding, the compiled replacement
+rules, chunk reading, process_region and write_block_data. End to end
+benchmarks run WorldAnalysis.py on a fresh copy of the world, for an
+analysis run and with Examples/Replace.json and Examples/vanilla.json.
+
+Results (blocks/s, chunks/s and peak RSS) are written as a JSON report,
+and a previous report can be passed with --compare to print the speedups.
+"""
+import os, sys
+import argparse
+import json
+import time
+import timeit
+import shutil
+import tempfile
+import resource
+import platform
+import subprocess
+from io import BytesIO
+from Queue import Queue
+from collections import Counter
+import numpy as np
+from nbt.nbt import NBTFile, MalformedFileError
+from utilities import (array_4bit_to_byte, array_byte_to_4bit, nibbles_to_array, array_to_nibbles,
+                       decode_section, encode_section, block_states)
+from replacement_rules import load_rules
+from region_io import RegionReader
+from nbt_reader import read_chunk
+from synthetic_world import generate_world
+import WorldAnalysis
+
+PACKAGE = os.path.dirname(os.path.abspath(__file__))
+RULE_FILES = [os.path.join(PACKAGE, "Examples", "Replace.json"),
+              os.path.join(PACKAGE, "Examples", "vanilla.json")]
+
+def best_time(function, number, repeat=3):
+    """Seconds per call of function, the best of repeat runs of number calls"""
+    return min(timeit.Timer(function).repeat(repeat=repeat, number=number)) / number
+
+def sample_chunks(world_folder):
+    """Return the decompressed data of the chunks of the first region file"""
+    region_folder = os.path.join(world_folder, "region")
+    reader = RegionReader(os.path.join(region_folder, sorted(os.listdir(region_folder))[0]))
+    chunks = [reader.read(index) for index in reader.chunk_indexes()]
+    reader.close()
+    return [chunk for chunk in chunks if chunk is not None]
+
+def micro_benchmarks(world_folder, number):
+    chunk_data = sample_chunks(world_folder)
+    chunk = NBTFile(buffer=BytesIO(chunk_data[0]))
+    section = max(chunk["Level"]["Sections"], key=lambda section: "Add" in section)
+    (blocks, data) = decode_section(section)
+    states = block_states(blocks, data)
+    nibbles = section["Data"].value
+    rules = [load_rules(rule_file) for rule_file in RULE_FILES]
+    region_folder = os.path.join(world_folder, "region")
+    region_file = os.path.join(region_folder, sorted(os.listdir(region_folder))[0])
+    world_data = Counter(dict(((i, i % 16, None, None), i) for i in range(20000)))
+    output_file = os.path.join(tempfile.mkdtemp(), "output.txt")
+    # process_region reads its settings from attributes set by process_init
+    options = WorldAnalysis.argument_parser().parse_args([world_folder])
+    WorldAnalysis.process_init(Queue(), None, options)
+
+    # (name, function, calls per timing, blocks handled per call)
+    cases = [
+        ("array_4bit_to_byte", lambda: array_4bit_to_byte(nibbles), number, 4096),
+        ("nibbles_to_array", lambda: nibbles_to_array(nibbles), number * 10, 4096),
+        ("array_byte_to_4bit", lambda: array_byte_to_4bit(data), number, 4096),
+        ("array_to_nibbles", lambda: array_to_nibbles(data), number * 10, 4096),
+        ("decode_section", lambda: decode_section(section), number * 10, 4096),
+        ("encode_section", lambda: encode_section(blocks, data), number * 10, 4096),
+        ("rules.matches_section (Replace.json)", lambda: rules[0].matches_section(states), number * 10, 4096),
+        ("rules.remap (vanilla.json)", lambda: rules[1].remap(states), number * 10, 4096),
+        ("nbt_reader.read_chunk", lambda: read_chunk(chunk_data[0]), number, None),
+        ("NBTFile", lambda: NBTFile(buffer=BytesIO(chunk_data[0])), number, None),
+        ("process_region", lambda: WorldAnalysis.process_region(region_file), 1, None),
+        ("write_block_data (20000 lines)", lambda: WorldAnalysis.write_block_data(world_data, output_file), 1, None),
+    ]
+    results = {}
+    for (name, function, calls, blocks_per_call) in cases:
+        seconds = best_time(function, calls)
+        result = {"seconds_per_call": seconds}
+        if blocks_per_call is not None:
+            result["blocks_per_second"] = blocks_per_call / seconds
+        results[name] = result
+        print("%-40s %12.1f us/call" % (name, seconds * 1e6))
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    shutil.rmtree(os.path.dirname(output_file))
+    return results
+
+def run_world_analysis(world_folder, arguments):
+    """
+    Run WorldAnalysis.py on a copy of world_folder, in a scratch directory.
+    Returns (exit code, seconds, peak RSS in KB of the run and its workers).
+    """
+    scratch = tempfile.mkdtemp()
+    try:
+        world_copy = os.path.join(scratch, "world")
+        shutil.copytree(world_folder, world_copy)
+        with open(os.path.join(scratch, "run.log"), "w") as log:
+            start = time.time()
+            process = subprocess.Popen([sys.executable, os.path.join(PACKAGE, "WorldAnalysis.py"),
+                                        world_copy] + arguments, cwd=scratch, stdout=log, stderr=log)
+            # wait4 reports the peak RSS of the run, including the pool
+            # workers it waited for
+            (_, status, usage) = os.wait4(process.pid, 0)
+            seconds = time.time() - start
+        return (os.WEXITSTATUS(status), seconds, usage.ru_maxrss)
+    finally:
+        shutil.rmtree(scratch)
+
+def end_to_end_benchmarks(world_folder, world_stats, workers):
+    cases = [("analysis", [])] + [(os.path.basename(rule_file), [rule_file]) for rule_file in RULE_FILES]
+    results = {}
+    for (name, arguments) in cases:
+        if workers:
+            arguments = arguments + ["--workers", str(workers)]
+        (exit_code, seconds, peak_rss) = run_world_analysis(world_folder, arguments)
+        results[name] = {"exit_code": exit_code, "seconds": seconds, "peak_rss_kb": peak_rss,
+                         "chunks_per_second": world_stats["chunks"] / seconds,
+                         "blocks_per_second": world_stats["blocks"] / seconds}
+        print("%-40s %8.2f s %12.0f blocks/s %8d KB peak%s" % (name, seconds, results[name]["blocks_per_second"],
+              peak_rss, "" if exit_code == 0 else " (exit code %d)" % exit_code))
+    return results
+
+def compare(report, previous):
+    """Print how much faster (>1) or slower each benchmark is than previously"""
+    for section in ("micro", "end_to_end"):
+        for (name, result) in sorted(report[section].items()):
+            if not isinstance(result, dict) or name not in previous.get(section, {}):
+                continue
+            old = previous[section][name]
+            key = "seconds_per_call" if "seconds_per_call" in result else "seconds"
+            print("%-40s %6.2fx" % (name, old[key] / result[key]))
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Benchmark WorldAnalysis.py on a synthetic world.")
+    parser.add_argument("--world", metavar="WORLD_FOLDER",
+                        help="benchmark an existing world, rather than generating one")
+    parser.add_argument("--regions", type=int, default=2)
+    parser.add_argument("--chunks", type=int, default=256, help="chunks per region (default 256)")
+    parser.add_argument("--sections", type=float, default=4.0)
+    parser.add_argument("--add-fraction", type=float, default=0.25)
+    parser.add_argument("--tile-density", type=float, default=0.05)
+    parser.add_argument("--nbt-variety", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--number", type=int, default=20, help="calls per micro benchmark timing")
+    parser.add_argument("--workers", type=int, default=None, help="workers for the end to end runs")
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    parser.add_argument("--output", default="benchmark-%s.json" % time.strftime("%Y%m%d-%H%M%S"),
+                        help="JSON report to write (default benchmark-TIMESTAMP.json)")
+    parser.add_argument("--compare", metavar="REPORT", help="previous JSON report to compare with")
+    return parser
+
+def main(options):
+    scratch = None
+    world_stats = {"sections_per_chunk": options.sections, "add_fraction": options.add_fraction,
+                   "tile_density": options.tile_density, "nbt_variety": options.nbt_variety,
+                   "seed": options.seed}
+    try:
+        if options.world:
+            world_folder = options.world
+            world_stats = {"world": world_folder}
+            chunk_count = 0
+            block_count = 0
+            malformed_count = 0
+            region_folder = os.path.join(world_folder, "region")
+            for region_file in os.listdir(region_folder):
+                reader = RegionReader(os.path.join(region_folder, region_file))
+                try:
+                    for index in reader.chunk_indexes():
+                        chunk_data = reader.read(index)
+                        if chunk_data is None:
+                            continue
+                        # Skipped like process_region skips them
+                        try:
+                            level = read_chunk(chunk_data, {"Level": {"Sections": {"Y": True}}})["Level"]
+                        except (MalformedFileError, KeyError):
+                            malformed_count += 1
+                            continue
+                        chunk_count += 1
+                        block_count += 4096 * len(level.get("Sections", ()))
+                finally:
+                    reader.close()
+            if malformed_count:
+                print("Skipped %d chunks that could not be read" % malformed_count)
+            world_stats.update(chunks=chunk_count, blocks=block_count)
+        else:
+            scratch = tempfile.mkdtemp()
+            world_folder = os.path.join(scratch, "world")
+            start = time.time()
+            world_stats.update(generate_world(world_folder, options.regions, options.chunks, options.sections,
+                                              options.add_fraction, options.tile_density,
+                                              options.nbt_variety, options.seed))
+            print("Generated %d chunks in %.1f s" % (world_stats["chunks"], time.time() - start))
+        report = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+                  "numpy": np.__version__, "world": world_stats,
+                  "micro": micro_benchmarks(world_folder, options.number), "end_to_end": {}}
+        if not options.skip_end_to_end:
+            report["end_to_end"] = end_to_end_benchmarks(world_folder, world_stats, options.workers)
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch)
+    with open(options.output, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    print("Wrote %s" % options.output)
+    if options.compare:
+        with open(options.compare) as previous:
+            compare(report, json.load(previous))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(argument_parser().parse_args()))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+Persistent index of where blocks are in a world, kept in an SQLite file.
+
+For every section of every chunk the index stores how often each block
+ID:Data pair occurs, and which tile entity signatures (the stripped NBT from
+output.txt) are found there. It is built by WorldAnalysis.py --index during
+an analysis run, and answers questions like "where is 250:14?" or "how many
+chunks hold 166 with pipeId 4307?" without opening the world:
+
+    python block_index.py INDEX where 250:14
+    python block_index.py INDEX count 166 --nbt pipeId=4307
+
+A replacement run given the same index only opens the chunks that hold a
+block one of its rules could change.
+Block states are packed the same way as utilities.block_states().
+"""
+import os
+import sys
+import json
+import sqlite3
+import argparse
+from collections import Counter
+from utilities import MAX_DATA
+from region_io import chunk_index
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS regions (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,
+                                    mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS blocks (region INTEGER, x INTEGER, z INTEGER, y INTEGER,
+                                   state INTEGER, count INTEGER);
+CREATE TABLE IF NOT EXISTS signatures (id INTEGER PRIMARY KEY, tile_id TEXT, nbt TEXT,
+                                       UNIQUE (tile_id, nbt));
+CREATE TABLE IF NOT EXISTS tiles (region INTEGER, x INTEGER, z INTEGER, y INTEGER,
+                                  state INTEGER, signature INTEGER, count INTEGER);
+CREATE INDEX IF NOT EXISTS blocks_state ON blocks (state);
+CREATE INDEX IF NOT EXISTS blocks_region ON blocks (region);
+CREATE INDEX IF NOT EXISTS tiles_state ON tiles (state);
+CREATE INDEX IF NOT EXISTS tiles_region ON tiles (region);
+"""
+
+def parse_block(block):
+    """Return the block states of an "ID" or "ID:Data" string"""
+    if ":" in block:
+        (block_id, data) = block.split(":", 1)
+        return [int(block_id) * MAX_DATA + int(data)]
+    return [int(block) * MAX_DATA + block_data for block_data in range(MAX_DATA)]
+
+class BlockIndex(object):
+    """
+    Blocks are counted per section, tile entities included, chunk x and z
+    are absolute chunk coordinates. Regions are keyed by absolute path, and
+    are only trusted while their (mtime, size) is the one they were indexed at.
+    """
+    def __init__(self, filename, tags_to_strip):
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+        self.connection.execute("CREATE TEMP TABLE query_states (state INTEGER PRIMARY KEY)")
+        # Signatures depend on the stripped tags, drop an index made with different ones
+        tags = json.dumps(list(tags_to_strip))
+        row = self.connection.execute("SELECT value FROM settings WHERE key = 'tags_to_strip'").fetchone()
+        if row is not None and row[0] != tags:
+            for table in ("regions", "blocks", "signatures", "tiles"):
+                self.connection.execute("DELETE FROM " + table)
+        self.connection.execute("INSERT OR REPLACE INTO settings VALUES ('tags_to_strip', ?)", (tags,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def region_id(self, region_file):
+        row = self.connection.execute("SELECT id FROM regions WHERE path = ?",
+                                      (os.path.abspath(region_file),)).fetchone()
+        return row[0] if row is not None else None
+
+    def is_current(self, region_file, signature):
+        """True if the region was indexed, and has not changed since"""
+        row = self.connection.execute("SELECT mtime, size FROM regions WHERE path = ?",
+                                      (os.path.abspath(region_file),)).fetchone()
+        return row is not None and tuple(row) == tuple(signature)
+
+    def signature_id(self, tile_id, nbt):
+        self.connection.execute("INSERT OR IGNORE INTO signatures (tile_id, nbt) VALUES (?, ?)",
+                                (tile_id, nbt))
+        return self.connection.execute("SELECT id FROM signatures WHERE tile_id = ? AND nbt = ?",
+                                       (tile_id, nbt)).fetchone()[0]
+
+    def forget_region(self, region_id):
+        for table in ("blocks", "tiles"):
+            self.connection.execute("DELETE FROM " + table + " WHERE region = ?", (region_id,))
+        self.connection.execute("DELETE FROM regions WHERE id = ?", (region_id,))
+
+    def update_region(self, region_file, signature, blocks, tiles):
+        """
+        Replace the entries of a region. blocks is an array of
+        (x, z, section Y, state, count) rows, tiles is a Counter of
+        (x, z, section Y, state, tile entity ID, stripped NBT) -> occurrences.
+        """
+        region_id = self.region_id(region_file)
+        if region_id is not None:
+            self.forget_region(region_id)
+        region_id = self.connection.execute(
+            "INSERT INTO regions (path, mtime, size) VALUES (?, ?, ?)",
+            (os.path.abspath(region_file), signature[0], signature[1])).lastrowid
+        self.connection.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)",
+                                    ([region_id] + row for row in blocks.tolist()))
+        signature_ids = {}
+        rows = []
+        for ((x, z, y, state, tile_id, nbt), count) in tiles.viewitems():
+            if (tile_id, nbt) not in signature_ids:
+                signature_ids[(tile_id, nbt)] = self.signature_id(tile_id, nbt)
+            rows.append((region_id, x, z, y, state, signature_ids[(tile_id, nbt)], count))
+        self.connection.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    def retain(self, region_files):
+        """Forget regions that no longer exist in the world"""
+        keep = set(os.path.abspath(region_file) for region_file in region_files)
+        for (region_id, path) in self.connection.execute("SELECT id, path FROM regions").fetchall():
+            if path not in keep:
+                self.forget_region(region_id)
+        self.connection.commit()
+
+    def set_query_states(self, states):
+        self.connection.execute("DELETE FROM query_states")
+        self.connection.executemany("INSERT OR IGNORE INTO query_states VALUES (?)",
+                                    ((int(state),) for state in states))
+        # Do not hold a transaction open over the queries that follow
+        self.connection.commit()
+
+    def chunks_with(self, region_file, states):
+        """Return the chunk_index() of the chunks in a region holding any of states"""
+        self.set_query_states(states)
+        rows = self.connection.execute(
+            "SELECT DISTINCT x, z FROM blocks JOIN query_states USING (state) WHERE region = ?",
+            (self.region_id(region_file),))
+        return set(chunk_index(x, z) for (x, z) in rows)
+
+    def region_inventory(self, region_file, exclude=()):
+        """
+        Return the inventory of a region, in the form WorldAnalysis.py
+        writes to output.txt, leaving out the chunk_index() in exclude.
+        """
+        region_id = self.region_id(region_file)
+        inventory = Counter()
+        for (x, z, state, signature, tile_id, nbt, count) in self.connection.execute(
+                "SELECT x, z, state, signature, tile_id, nbt, count FROM tiles "
+                "JOIN signatures ON signatures.id = signature WHERE region = ?", (region_id,)):
+            if chunk_index(x, z) not in exclude:
+                inventory[(state // MAX_DATA, state % MAX_DATA, tile_id, nbt)] += count
+                inventory[(state // MAX_DATA, state % MAX_DATA, None, None)] -= count
+        for (x, z, state, count) in self.connection.execute(
+                "SELECT x, z, state, count FROM blocks WHERE region = ?", (region_id,)):
+            if chunk_index(x, z) not in exclude:
+                inventory[(state // MAX_DATA, state % MAX_DATA, None, None)] += count
+        return Counter(dict((block, count) for (block, count) in inventory.viewitems() if count > 0))
+
+    def matching_signatures(self, nbt_filter):
+        """Return the IDs of the signatures whose tags equal all of nbt_filter"""
+        matches = []
+        for (signature, nbt) in self.connection.execute("SELECT id, nbt FROM signatures"):
+            tags = json.loads(nbt)
+            if all(tag in tags and tags[tag] == value for (tag, value) in nbt_filter.viewitems()):
+                matches.append(signature)
+        return matches
+
+    def where(self, states, nbt_filter=None):
+        """
+        Return (region file, chunk x, chunk z, section Y, count) of every
+        section holding any of states. With an nbt_filter only blocks with a
+        matching tile entity are counted.
+        """
+        self.set_query_states(states)
+        if nbt_filter is None:
+            query = ("SELECT path, x, z, y, SUM(count) FROM blocks JOIN query_states USING (state) "
+                     "JOIN regions ON regions.id = region GROUP BY region, x, z, y ORDER BY path, x, z, y")
+            return self.connection.execute(query).fetchall()
+        signatures = self.matching_signatures(nbt_filter)
+        query = ("SELECT path, x, z, y, SUM(count) FROM tiles JOIN query_states USING (state) "
+                 "JOIN regions ON regions.id = region WHERE signature IN (%s) "
+                 "GROUP BY region, x, z, y ORDER BY path, x, z, y" % ",".join("?" * len(signatures)))
+        return self.connection.execute(query, signatures).fetchall()
+
+def parse_nbt_filter(filters):
+    """Turn TAG=VALUE strings into a dict, values are JSON where they parse as such"""
+    nbt_filter = {}
+    for tag_filter in filters:
+        (tag, value) = tag_filter.split("=", 1)
+        try:
+            nbt_filter[tag] = json.loads(value)
+        except ValueError:
+            nbt_filter[tag] = value
+    return nbt_filter
+
+def main(options):
+    if not os.path.exists(options.index):
+        print("No such index as " + options.index)
+        return 72 # EX_IOERR
+    from WorldAnalysis import tags_to_strip
+    index = BlockIndex(options.index, tags_to_strip)
+    nbt_filter = parse_nbt_filter(options.nbt) if options.nbt else None
+    sections = index.where(parse_block(options.block), nbt_filter)
+    if options.query == "where":
+        for (region_file, x, z, y, count) in sections:
+            print("{0};{1};{2};{3};{4}".format(region_file, x, z, y, count))
+    else:
+        chunks = set((region_file, x, z) for (region_file, x, z, _, _) in sections)
+        print("{0} blocks in {1} sections of {2} chunks".format(
+            sum(section[4] for section in sections), len(sections), len(chunks)))
+    index.close()
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query a block index built by WorldAnalysis.py --index.")
+    parser.add_argument("index", metavar="INDEX")
+    parser.add_argument("query", choices=["where", "count"],
+                        help="where: list the sections holding the block. count: total the "
+                        "blocks, and the chunks holding them")
+    parser.add_argument("block", metavar="ID[:DATA]")
+    parser.add_argument("--nbt", action="append", metavar="TAG=VALUE",
+                        help="only count blocks whose tile entity has this tag value, may be repeated")
+    sys.exit(main(parser.parse_args()))
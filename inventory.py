@@ -0,0 +1,127 @@
+"""
+Compact block inventories, for sending results from the pool workers.
+
+An inventory is a Counter of (block ID, data, tile entity ID, stripped NBT)
+-> occurrences. Pickled as is, every key is a tuple of four objects, and the
+stripped NBT of every tile entity signature is sent again with every region
+and held again by the parent. A CompactInventory packs block ID and data into
+one state, as utilities.block_states() does, and refers to tile entity
+signatures by their position in a table sent once with the region. The table
+comes with a hash of its contents, so the parent only has to look up the
+signatures of a table the first time it sees one.
+
+The parent keeps the world totals in an Inventory, which interns each
+signature once, and stores block states against signature IDs.
+"""
+import copy
+import json
+import hashlib
+import itertools
+from collections import Counter
+import numpy as np
+from utilities import MAX_DATA, BLOCK_STATES
+
+# Reference of blocks without a tile entity
+NO_SIGNATURE = -1
+
+class CompactInventory(object):
+    """
+    One or more inventories sharing a signature table. parts maps the key
+    each inventory was given to (states, refs, counts) arrays, where refs
+    index signatures, a list of (tile entity ID, stripped NBT).
+    """
+    def __init__(self, inventories):
+        refs_by_signature = {}
+        self.parts = {}
+        for (key, inventory) in inventories.viewitems():
+            states = []
+            refs = []
+            for (block_id, data, tile_id, nbt) in inventory:
+                states.append(block_id * MAX_DATA + data)
+                if tile_id is None and nbt is None:
+                    refs.append(NO_SIGNATURE)
+                else:
+                    refs.append(refs_by_signature.setdefault((tile_id, nbt), len(refs_by_signature)))
+            self.parts[key] = (np.array(states, dtype=np.uint32), np.array(refs, dtype=np.int32),
+                               np.fromiter(inventory.viewvalues(), dtype=np.int64, count=len(inventory)))
+        self.signatures = sorted(refs_by_signature, key=refs_by_signature.get)
+        self.digest = hashlib.sha1(json.dumps(self.signatures)).digest()
+
+class Inventory(object):
+    """
+    World totals. Blocks without a tile entity are counted in an array
+    indexed by block state, those with one in a Counter of
+    (state, signature ID) -> occurrences.
+    """
+    def __init__(self):
+        self.block_counts = np.zeros(BLOCK_STATES, dtype=np.int64)
+        self.tiles = Counter()
+        self.signatures = []
+        self.signature_ids = {}
+        # Signature IDs of the tables seen so far, by digest
+        self.tables = {}
+
+    def signature_id(self, signature):
+        signature_id = self.signature_ids.get(signature)
+        if signature_id is None:
+            signature_id = self.signature_ids[signature] = len(self.signatures)
+            self.signatures.append(signature)
+        return signature_id
+
+    def table_ids(self, compact):
+        """Return the signature IDs of the table of a CompactInventory"""
+        ids = self.tables.get(compact.digest)
+        if ids is None:
+            ids = self.tables[compact.digest] = np.array(
+                [self.signature_id(signature) for signature in compact.signatures], dtype=np.int64)
+        return ids
+
+    def add(self, compact, key=None):
+        """Add one part of a CompactInventory to the totals"""
+        (states, refs, counts) = compact.parts[key]
+        plain = refs == NO_SIGNATURE
+        np.add.at(self.block_counts, states[plain], counts[plain])
+        ids = self.table_ids(compact)
+        tiled = ~plain
+        for (state, signature_id, count) in itertools.izip(states[tiled].tolist(), ids[refs[tiled]].tolist(),
+                                                           counts[tiled].tolist()):
+            self.tiles[(state, signature_id)] += count
+
+    def expand(self, compact, key=None):
+        """Return one part of a CompactInventory as an inventory Counter"""
+        (states, refs, counts) = compact.parts[key]
+        ids = self.table_ids(compact)
+        inventory = Counter()
+        for (state, ref, count) in itertools.izip(states.tolist(), refs.tolist(), counts.tolist()):
+            if ref == NO_SIGNATURE:
+                (tile_id, nbt) = (None, None)
+            else:
+                # Use the interned copy of the signature
+                (tile_id, nbt) = self.signatures[ids[ref]]
+            inventory[(state // MAX_DATA, state % MAX_DATA, tile_id, nbt)] += count
+        return inventory
+
+    def update(self, inventory):
+        """Add an inventory Counter to the totals"""
+        for ((block_id, data, tile_id, nbt), count) in inventory.viewitems():
+            state = block_id * MAX_DATA + data
+            if tile_id is None and nbt is None:
+                self.block_counts[state] += count
+            else:
+                self.tiles[(state, self.signature_id((tile_id, nbt)))] += count
+
+    def with_block_counts(self, block_counts):
+        """Return a copy of the totals with block_counts added, sharing the tile entity counts"""
+        inventory = copy.copy(self)
+        inventory.block_counts = self.block_counts + block_counts
+        return inventory
+
+    def viewitems(self):
+        """Iterate over the totals as (block ID, data, tile entity ID, stripped NBT), occurrences"""
+        present = np.flatnonzero(self.block_counts)
+        for (state, count) in itertools.izip(present.tolist(), self.block_counts[present].tolist()):
+            yield ((state // MAX_DATA, state % MAX_DATA, None, None), count)
+        for ((state, signature_id), count) in self.tiles.viewitems():
+            if count:
+                (tile_id, nbt) = self.signatures[signature_id]
+                yield ((state // MAX_DATA, state % MAX_DATA, tile_id, nbt), count)
@@ -0,0 +1,210 @@
+"""
+Columnar inventory files, for tools that read the inventory repeatedly.
+
+output.txt holds one text line per distinct block, and readers have to parse
+every line, NBT included, to use any of it. An inventory file is an .npz of
+equal length columns, one row per region, block state and tile entity
+signature:
+
+    block_id, data  the block, as in output.txt
+    signature       index into the signature table, NO_SIGNATURE for blocks
+                    without a tile entity
+    region          index into the region table, NO_REGION for the rows of
+                    counts only kept per dimension, see shared_counts.py
+    dimension       index into the dimension table
+    count           occurrences
+
+The tables are stored as JSON text in uint8 arrays: regions, dimensions,
+and signatures, a list of [tile entity ID, stripped NBT as JSON]. Each
+distinct signature is stored once, however many rows refer to it.
+
+InventoryFile reads it lazily. np.load() only reads a column once it is
+used, and tables and NBT are only decoded when asked for.
+"""
+import json
+import itertools
+from collections import Counter
+import numpy as np
+from utilities import MAX_DATA, BLOCK_STATES
+from inventory import NO_SIGNATURE
+
+NO_REGION = -1
+# Merge the rows gathered so far once there are this many parts of them
+CONSOLIDATE_PARTS = 256
+
+def encode_table(table):
+    return np.frombuffer(json.dumps(table), dtype=np.uint8)
+
+def decode_table(array):
+    return json.loads(array.tostring())
+
+class InventoryColumns(object):
+    """
+    Rows of counts per region, gathered as results come in. region_tags maps
+    every region file to the name of its dimension. Signature IDs are those
+    of the world inventory.Inventory, whose signatures are written as the
+    signature table.
+    """
+    def __init__(self, region_tags):
+        self.regions = sorted(region_tags)
+        self.region_ids = dict((region_file, i) for (i, region_file) in enumerate(self.regions))
+        self.dimensions = sorted(set(region_tags.viewvalues()))
+        self.region_dimensions = np.array([self.dimensions.index(region_tags[region_file])
+                                           for region_file in self.regions], dtype=np.int32)
+        # (rows of region, state and signature, counts) parts
+        self.parts = []
+
+    def add(self, region_file, states, signature_ids, counts):
+        """Add the counts of a region, states and signature_ids given per count"""
+        rows = np.empty((len(counts), 3), dtype=np.int64)
+        rows[:, 0] = self.region_ids[region_file]
+        rows[:, 1] = states
+        rows[:, 2] = signature_ids
+        self.parts.append((rows, np.asarray(counts, dtype=np.int64)))
+        if len(self.parts) >= CONSOLIDATE_PARTS:
+            self.parts = [self.consolidate()]
+
+    def add_inventory(self, region_file, inventory, world_data):
+        """Add an inventory Counter, interning its signatures in world_data"""
+        states = []
+        signature_ids = []
+        for (block_id, data, tile_id, nbt) in inventory:
+            states.append(block_id * MAX_DATA + data)
+            if tile_id is None and nbt is None:
+                signature_ids.append(NO_SIGNATURE)
+            else:
+                signature_ids.append(world_data.signature_id((tile_id, nbt)))
+        self.add(region_file, states, signature_ids,
+                 np.fromiter(inventory.viewvalues(), dtype=np.int64, count=len(inventory)))
+
+    def consolidate(self):
+        """Return the rows gathered so far, summing the counts of equal rows"""
+        if not self.parts:
+            return (np.empty((0, 3), dtype=np.int64), np.empty(0, dtype=np.int64))
+        rows = np.concatenate([part_rows for (part_rows, _) in self.parts])
+        counts = np.concatenate([part_counts for (_, part_counts) in self.parts])
+        (rows, inverse) = np.unique(rows, axis=0, return_inverse=True)
+        totals = np.zeros(len(rows), dtype=np.int64)
+        np.add.at(totals, inverse, counts)
+        present = totals != 0
+        return (rows[present], totals[present])
+
+    def save(self, filename, signatures, dimension_counts=None):
+        """
+        Write the inventory file. signatures is the signature table, a list of
+        (tile entity ID, stripped NBT). dimension_counts, a (dimensions,
+        BLOCK_STATES) array, adds counts only known per dimension.
+        """
+        (rows, counts) = self.consolidate()
+        self.parts = [(rows, counts)]
+        (regions, states, signature_ids) = rows.T
+        dimensions = self.region_dimensions[regions]
+        if dimension_counts is not None:
+            (extra_dimensions, extra_states) = np.nonzero(dimension_counts)
+            regions = np.concatenate([regions, np.full(len(extra_states), NO_REGION, dtype=np.int64)])
+            dimensions = np.concatenate([dimensions, extra_dimensions])
+            states = np.concatenate([states, extra_states])
+            signature_ids = np.concatenate([signature_ids,
+                                            np.full(len(extra_states), NO_SIGNATURE, dtype=np.int64)])
+            counts = np.concatenate([counts, dimension_counts[extra_dimensions, extra_states]])
+        with open(filename, "wb") as output:
+            np.savez(output,
+                     block_id=(states // MAX_DATA).astype(np.uint16),
+                     data=(states % MAX_DATA).astype(np.uint8),
+                     signature=signature_ids.astype(np.int32),
+                     region=regions.astype(np.int32),
+                     dimension=dimensions.astype(np.int16),
+                     count=counts.astype(np.int64),
+                     regions=encode_table(self.regions),
+                     dimensions=encode_table(self.dimensions),
+                     signatures=encode_table(list(signatures)))
+
+class InventoryFile(object):
+    """
+    Lazy reader of an inventory file. Columns are read as numpy arrays the
+    first time they are used, by column(). nbt() decodes the NBT of a single
+    signature.
+    """
+    def __init__(self, filename):
+        self.arrays = np.load(filename)
+        self.columns = {}
+        self.tables = {}
+
+    def close(self):
+        self.arrays.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def column(self, name):
+        array = self.columns.get(name)
+        if array is None:
+            array = self.columns[name] = self.arrays[name]
+        return array
+
+    def table(self, name):
+        table = self.tables.get(name)
+        if table is None:
+            table = self.tables[name] = decode_table(self.arrays[name])
+        return table
+
+    @property
+    def regions(self):
+        return self.table("regions")
+
+    @property
+    def dimensions(self):
+        return self.table("dimensions")
+
+    @property
+    def signatures(self):
+        """The signature table, as [tile entity ID, stripped NBT as JSON]"""
+        return self.table("signatures")
+
+    def nbt(self, signature_id):
+        """Return the stripped NBT of a signature, decoded"""
+        return json.loads(self.signatures[signature_id][1])
+
+    def select(self, region=None, dimension=None):
+        """Return the row mask of a region file or dimension name, None for all rows"""
+        mask = None
+        if region is not None:
+            mask = self.column("region") == self.regions.index(region)
+        if dimension is not None:
+            in_dimension = self.column("dimension") == self.dimensions.index(dimension)
+            mask = in_dimension if mask is None else mask & in_dimension
+        return mask
+
+    def block_counts(self, region=None, dimension=None):
+        """Return the count of every block state, tile entities included"""
+        counts = self.column("count")
+        states = self.column("block_id").astype(np.int64) * MAX_DATA + self.column("data")
+        mask = self.select(region, dimension)
+        if mask is not None:
+            (counts, states) = (counts[mask], states[mask])
+        totals = np.zeros(BLOCK_STATES, dtype=np.int64)
+        np.add.at(totals, states, counts)
+        return totals
+
+    def inventory(self, region=None, dimension=None):
+        """
+        Return a Counter of (block ID, data, tile entity ID, stripped NBT) ->
+        occurrences, as written to output.txt, of the whole file, a region
+        file or a dimension.
+        """
+        columns = [self.column(name) for name in ("block_id", "data", "signature", "count")]
+        mask = self.select(region, dimension)
+        if mask is not None:
+            columns = [column[mask] for column in columns]
+        signatures = self.signatures
+        inventory = Counter()
+        for (block_id, data, signature, count) in itertools.izip(*[column.tolist() for column in columns]):
+            if signature == NO_SIGNATURE:
+                inventory[(block_id, data, None, None)] += count
+            else:
+                (tile_id, nbt) = signatures[signature]
+                inventory[(block_id, data, tile_id, nbt)] += count
+        return inventory
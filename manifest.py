@@ -0,0 +1,175 @@
+"""
+Manifest of a previous run, used for incremental re-scans.
+
+For every region file the manifest records its mtime and size, and for each
+of its chunks the timestamp from the region header along with that chunk's
+contribution to the inventory. A later run only has to scan the regions and
+chunks that changed, and takes everything else from the manifest.
+
+Replacement runs additionally mark each region once it has been fully
+processed, so an interrupted run can be resumed with the same replacements
+file without redoing the regions that were already finished. Those marks
+are appended to a journal next to the manifest as each region finishes,
+rather than rewriting the whole manifest every time. Loading the manifest
+replays the journal, and save() folds it back into the manifest.
+"""
+import os
+import json
+import hashlib
+from collections import Counter
+from region_io import replace_file
+
+MANIFEST_VERSION = 1
+JOURNAL_SUFFIX = ".journal"
+
+def file_signature(filename):
+    """Return (mtime, size) of a file, used to spot changed region files"""
+    stat = os.stat(filename)
+    return (stat.st_mtime, stat.st_size)
+
+def rules_digest(replacement_file_name):
+    """Hash of a replacements file, so resumed runs use the same rules"""
+    with open(replacement_file_name, 'rb') as replacement_file:
+        return hashlib.sha1(replacement_file.read()).hexdigest()
+
+class Manifest(object):
+    """
+    Regions are keyed by absolute path, chunks by region_io.chunk_index().
+    Chunk inventories are Counters of
+    (block ID, data, tile entity ID, stripped NBT) -> occurrences.
+    """
+    def __init__(self, filename, tags_to_strip):
+        self.filename = filename
+        # Inventories depend on the stripped tags, a manifest made with
+        # different ones can not be reused
+        self.tags_to_strip = list(tags_to_strip)
+        self.regions = {}
+        self.journal_file = filename + JOURNAL_SUFFIX
+        self.journal = None
+        if os.path.exists(filename):
+            with open(filename, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if self.is_compatible(manifest):
+                self.regions = manifest["regions"]
+        if os.path.exists(self.journal_file):
+            self.replay_journal()
+
+    def header(self):
+        return {"version": MANIFEST_VERSION, "tags_to_strip": self.tags_to_strip}
+
+    def is_compatible(self, header):
+        return (header.get("version") == MANIFEST_VERSION and
+                header.get("tags_to_strip") == self.tags_to_strip)
+
+    def replay_journal(self):
+        """Take in the regions recorded in the journal since the manifest was last saved"""
+        with open(self.journal_file, 'r') as journal_file:
+            for (number, line) in enumerate(journal_file):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line is cut short if the run was killed while writing it
+                    break
+                if number == 0:
+                    if not self.is_compatible(record):
+                        break
+                else:
+                    self.regions[record["region"]] = record["entry"]
+
+    def __len__(self):
+        return len(self.regions)
+
+    def region(self, region_file):
+        return self.regions.get(os.path.abspath(region_file))
+
+    def is_unchanged(self, region_file, signature):
+        """True if the region file was fully scanned, and has not changed since"""
+        entry = self.region(region_file)
+        return entry is not None and (entry["mtime"], entry["size"]) == signature
+
+    def is_replaced(self, region_file, digest, signature):
+        """True if a replacement run with these rules already finished the region"""
+        entry = self.region(region_file)
+        if entry is None or "replaced" not in entry:
+            return False
+        replaced = entry["replaced"]
+        return replaced["rules"] == digest and (replaced["mtime"], replaced["size"]) == signature
+
+    def chunk_timestamps(self, region_file):
+        """Return {chunk index: timestamp} of the chunks known for a region"""
+        entry = self.region(region_file)
+        if entry is None:
+            return {}
+        return dict((int(index), chunk["timestamp"]) for (index, chunk) in entry["chunks"].viewitems())
+
+    def chunk_inventory(self, region_file, index):
+        entry = self.region(region_file)
+        inventory = Counter()
+        for (block_id, data, tile_id, nbt, count) in entry["chunks"][str(index)]["inventory"]:
+            inventory[(block_id, data, tile_id, nbt)] = count
+        return inventory
+
+    def region_inventory(self, region_file):
+        inventory = Counter()
+        for index in self.region(region_file)["chunks"]:
+            inventory.update(self.chunk_inventory(region_file, index))
+        return inventory
+
+    def update_region(self, region_file, signature, chunks):
+        """
+        Record a scanned region. chunks maps every chunk index present in the
+        region to (timestamp, inventory), where an inventory of None means the
+        chunk was unchanged and the recorded one is kept.
+        """
+        previous = self.region(region_file)
+        entry = {"mtime": signature[0], "size": signature[1], "chunks": {}}
+        for (index, (timestamp, inventory)) in chunks.viewitems():
+            if inventory is None:
+                chunk = previous["chunks"][str(index)]
+            else:
+                chunk = {"timestamp": timestamp,
+                         "inventory": [list(block) + [count] for (block, count) in inventory.viewitems()]}
+            entry["chunks"][str(index)] = chunk
+        self.regions[os.path.abspath(region_file)] = entry
+
+    def mark_replaced(self, region_file, digest):
+        """Record that a replacement run finished this region"""
+        (mtime, size) = file_signature(region_file)
+        self.region(region_file)["replaced"] = {"rules": digest, "mtime": mtime, "size": size}
+
+    def record(self, region_file):
+        """
+        Append the entry of a region to the journal, so it survives an
+        interrupted run without saving the whole manifest.
+        """
+        if self.journal is None:
+            if os.path.exists(self.journal_file):
+                # Left over from an interrupted run, it was replayed on loading
+                self.save()
+            self.journal = open(self.journal_file, 'w')
+            self.journal.write(json.dumps(self.header()) + "\n")
+        region_file = os.path.abspath(region_file)
+        self.journal.write(json.dumps({"region": region_file, "entry": self.regions[region_file]}) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def retain(self, region_files):
+        """Forget regions that no longer exist in the world"""
+        keep = set(os.path.abspath(region_file) for region_file in region_files)
+        for region_file in list(self.regions):
+            if region_file not in keep:
+                del self.regions[region_file]
+
+    def save(self):
+        """Write the whole manifest, which makes the journal redundant"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        temp_file = self.filename + ".tmp"
+        manifest = self.header()
+        manifest["regions"] = self.regions
+        with open(temp_file, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        replace_file(temp_file, self.filename)
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
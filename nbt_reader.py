@@ -0,0 +1,216 @@
+"""
+Selective reader for the NBT data of a chunk.
+
+The nbt package builds a TAG object for every tag of a chunk, including the
+Entities, HeightMap, Biomes and TileTicks that process_region never looks at.
+read_chunk() walks the decompressed data once, and only builds values for
+the tag paths it is asked for. Everything else is skipped over by length.
+Byte arrays at the requested paths are returned as memoryviews into the
+decompressed data, rather than copied.
+
+Paths are given as nested dicts of tag names. A leaf of True reads that tag,
+and a leaf of ALL reads it along with everything below it as the plain
+Python values utilities.unpack_nbt() would return. Dicts also filter the
+compounds inside lists, so {"Sections": {"Y": True}} reads the Y of every
+section. Chunks that are going to be modified still need the full parser,
+as only its TAG objects can be written back.
+
+Run as a script, it checks read_chunk() against the nbt package on every
+chunk of the worlds or region files it is given.
+"""
+import struct
+from io import BytesIO
+from nbt.nbt import NBTFile, TAG_Compound, TAG_List, MalformedFileError
+
+(TAG_END, TAG_BYTE, TAG_SHORT, TAG_INT, TAG_LONG, TAG_FLOAT, TAG_DOUBLE, TAG_BYTE_ARRAY,
+ TAG_STRING, TAG_LIST, TAG_COMPOUND, TAG_INT_ARRAY, TAG_LONG_ARRAY) = range(13)
+
+SCALARS = {TAG_BYTE: struct.Struct(">b"), TAG_SHORT: struct.Struct(">h"),
+           TAG_INT: struct.Struct(">i"), TAG_LONG: struct.Struct(">q"),
+           TAG_FLOAT: struct.Struct(">f"), TAG_DOUBLE: struct.Struct(">d")}
+# Element formats of the tags holding a length prefixed array
+ARRAYS = {TAG_BYTE_ARRAY: "b", TAG_INT_ARRAY: "i", TAG_LONG_ARRAY: "q"}
+TYPE = struct.Struct(">B")
+NAME_LENGTH = struct.Struct(">H")
+LENGTH = struct.Struct(">i")
+
+ALL = "all"
+
+# The parts of a chunk WorldAnalysis.process_region reads
+CHUNK_PATHS = {"Level": {"xPos": True, "zPos": True,
+                         "Sections": {"Y": True, "Blocks": True, "Data": True, "Add": True},
+                         "TileEntities": ALL}}
+
+class NBTReader(object):
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.offset = 0
+
+    def unpack(self, fmt):
+        value = fmt.unpack_from(self.data, self.offset)[0]
+        self.offset += fmt.size
+        return value
+
+    def advance(self, length):
+        """Move past length bytes, which have to be within the data"""
+        if not 0 <= length <= len(self.data) - self.offset:
+            raise MalformedFileError("Tag length %d runs past the end of the data" % length)
+        self.offset += length
+
+    def unpack_length(self, item_size):
+        """Read an array or list length, checking its items of item_size bytes fit in the data"""
+        length = self.unpack(LENGTH)
+        if not 0 <= length * item_size <= len(self.data) - self.offset:
+            raise MalformedFileError("Length %d runs past the end of the data" % length)
+        return length
+
+    def item_size(self, item_type):
+        """The fewest bytes a list item can take up"""
+        return SCALARS[item_type].size if item_type in SCALARS else 1
+
+    def read_string(self):
+        length = self.unpack(NAME_LENGTH)
+        value = self.data[self.offset:self.offset + length].decode("utf-8")
+        self.offset += length
+        return value
+
+    def skip(self, tag_type):
+        """Move past the payload of a tag without reading it"""
+        if tag_type in SCALARS:
+            self.advance(SCALARS[tag_type].size)
+        elif tag_type in ARRAYS:
+            size = struct.calcsize(ARRAYS[tag_type])
+            self.advance(self.unpack_length(size) * size)
+        elif tag_type == TAG_STRING:
+            length = self.unpack(NAME_LENGTH)
+            self.advance(length)
+        elif tag_type == TAG_LIST:
+            item_type = self.unpack(TYPE)
+            length = self.unpack_length(self.item_size(item_type))
+            if item_type in SCALARS:
+                self.advance(length * SCALARS[item_type].size)
+            else:
+                for _ in xrange(length):
+                    self.skip(item_type)
+        elif tag_type == TAG_COMPOUND:
+            while True:
+                item_type = self.unpack(TYPE)
+                if item_type == TAG_END:
+                    break
+                length = self.unpack(NAME_LENGTH)
+                self.advance(length)
+                self.skip(item_type)
+        else:
+            raise MalformedFileError("Unknown tag type %d" % tag_type)
+
+    def read(self, tag_type, paths):
+        """Read the payload of a tag, only descending into the requested paths"""
+        if tag_type in SCALARS:
+            return self.unpack(SCALARS[tag_type])
+        if tag_type == TAG_BYTE_ARRAY:
+            length = self.unpack_length(1)
+            value = self.view[self.offset:self.offset + length]
+            self.offset += length
+            # Values nested under ALL have to match what the nbt package returns
+            return bytearray(value) if paths is ALL else value
+        if tag_type in ARRAYS:
+            length = self.unpack_length(struct.calcsize(ARRAYS[tag_type]))
+            fmt = struct.Struct(">%d%s" % (length, ARRAYS[tag_type]))
+            return list(self.unpack(fmt))
+        if tag_type == TAG_STRING:
+            return self.read_string()
+        if tag_type == TAG_LIST:
+            item_type = self.unpack(TYPE)
+            length = self.unpack_length(self.item_size(item_type))
+            return [self.read(item_type, paths) for _ in xrange(length)]
+        if tag_type == TAG_COMPOUND:
+            compound = {}
+            while True:
+                item_type = self.unpack(TYPE)
+                if item_type == TAG_END:
+                    return compound
+                name = self.read_string()
+                item_paths = paths.get(name) if isinstance(paths, dict) else paths
+                if item_paths is None:
+                    self.skip(item_type)
+                else:
+                    compound[name] = self.read(item_type, item_paths)
+        raise MalformedFileError("Unknown tag type %d" % tag_type)
+
+def read_chunk(data, paths=CHUNK_PATHS):
+    """
+    Read the requested paths from the decompressed NBT data of a chunk.
+    Returns the root compound as a dict. Byte arrays outside of ALL paths
+    are memoryviews, and are only valid as long as data is kept around.
+    """
+    reader = NBTReader(data)
+    try:
+        if reader.unpack(TYPE) != TAG_COMPOUND:
+            raise MalformedFileError("Chunk data does not start with a compound")
+        reader.read_string()
+        return reader.read(TAG_COMPOUND, paths)
+    except (struct.error, UnicodeDecodeError, RuntimeError) as e:
+        # Truncated data, or lists nested too deep to be real chunk data
+        raise MalformedFileError("Chunk data is malformed: %s" % e)
+
+def plain_values(value):
+    """Turn the byte arrays of a read_chunk() result into bytes, for comparison"""
+    if isinstance(value, dict):
+        return dict((name, plain_values(item)) for (name, item) in value.items())
+    if isinstance(value, list):
+        return [plain_values(item) for item in value]
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return value
+
+def expected_values(tag, paths):
+    """What read_chunk() should return for the paths of a tag read by the nbt package"""
+    if isinstance(tag, TAG_Compound):
+        if not isinstance(paths, dict):
+            return dict((item.name, expected_values(item, paths)) for item in tag.tags)
+        return dict((item.name, expected_values(item, paths[item.name]))
+                    for item in tag.tags if item.name in paths)
+    if isinstance(tag, TAG_List):
+        return [expected_values(item, paths) for item in tag.tags]
+    return plain_values(tag.value)
+
+def matches_nbt(data, paths=CHUNK_PATHS):
+    """True if read_chunk() reads data the way the nbt package does"""
+    expected = expected_values(NBTFile(buffer=BytesIO(data)), paths)
+    return plain_values(read_chunk(data, paths)) == expected
+
+# Check read_chunk() against the nbt package on every chunk of some worlds or
+# region files, as a regression check
+if __name__ == '__main__':
+    import os, sys, glob
+    from region_io import RegionReader
+    region_files = []
+    for path in sys.argv[1:]:
+        if os.path.isdir(path):
+            region_files.extend(sorted(glob.glob(os.path.join(path, "region", "*.mca"))))
+        else:
+            region_files.append(path)
+    (checked, failed) = (0, 0)
+    for region_file in region_files:
+        reader = RegionReader(region_file)
+        try:
+            for index in reader.chunk_indexes():
+                data = reader.read(index)
+                if data is None:
+                    continue
+                checked += 1
+                try:
+                    matched = matches_nbt(data)
+                except MalformedFileError as e:
+                    matched = False
+                    print("Chunk %d,%d of %s: %s" % (index % 32, index // 32, region_file, e))
+                if not matched:
+                    failed += 1
+                    print("Chunk %d,%d of %s is read differently" % (index % 32, index // 32, region_file))
+        finally:
+            reader.close()
+    print("%d of %d chunks read differently from the nbt package" % (failed, checked))
+    sys.exit(1 if failed or not checked else 0)
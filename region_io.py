@@ -0,0 +1,293 @@
+"""
+Raw access to Anvil region files.
+
+A region file starts with two 4 KiB tables, holding the location and the
+timestamp of each of its 32x32 chunks. Each chunk is stored as a 4 byte
+length, a 1 byte compression type and the compressed NBT data, padded to a
+multiple of 4 KiB sectors. The functions here work on that raw form, so
+chunks that are not changed never have to be decompressed or parsed.
+"""
+import os
+import sys
+import mmap
+import struct
+import tempfile
+import time
+import zlib
+import shutil
+import threading
+from io import BytesIO
+from collections import deque
+from Queue import Queue
+import nbt.region
+
+SECTOR_LENGTH = 4096
+CHUNKS_PER_REGION = 1024
+COMPRESSION_GZIP = 1
+COMPRESSION_ZLIB = 2
+COMPRESSION_NONE = 3
+# A chunk may not span more sectors than fit in a location entry
+MAX_CHUNK_SECTORS = 255
+# zlib levels of the compression policies, "default" is the level
+# Minecraft and the nbt package use
+COMPRESSION_LEVELS = {"fast": 1, "default": -1, "max": 9}
+
+def chunk_index(x, z):
+    """Return the header index of chunk x,z (region relative, or absolute)"""
+    return (x % 32) + (z % 32) * 32
+
+def read_header(region_file):
+    """
+    Read the location and timestamp tables from an open region file.
+    Returns (locations, timestamps), lists of 1024 entries indexed with
+    chunk_index(). Locations are (sector offset, sector count) tuples.
+    """
+    region_file.seek(0)
+    header = region_file.read(2 * SECTOR_LENGTH)
+    if len(header) < 2 * SECTOR_LENGTH:
+        # Empty (or truncated) region files hold no chunks
+        return ([(0, 0)] * CHUNKS_PER_REGION, [0] * CHUNKS_PER_REGION)
+    locations = [(location >> 8, location & 255) for location in
+                 struct.unpack(">1024I", header[:SECTOR_LENGTH])]
+    timestamps = list(struct.unpack(">1024I", header[SECTOR_LENGTH:]))
+    return (locations, timestamps)
+
+def read_raw_chunk(region_file, location, file_size):
+    """
+    Return the stored record of a chunk, length and compression type
+    included but without the sector padding. Returns None if the chunk does
+    not exist, or its location does not point inside the file.
+    """
+    (offset, sectors) = location
+    if offset < 2 or sectors == 0 or (offset + sectors) * SECTOR_LENGTH > file_size:
+        return None
+    region_file.seek(offset * SECTOR_LENGTH)
+    record = region_file.read(sectors * SECTOR_LENGTH)
+    length = struct.unpack(">I", record[:4])[0]
+    if length == 0 or length + 4 > len(record):
+        return None
+    return record[:length + 4]
+
+class RegionReader(object):
+    """
+    Read only access to the chunks of a region file through mmap. The header
+    tables are parsed once when the file is opened. Reading a chunk slices
+    its compressed data straight out of the mapping, without a copy.
+    read_seconds totals the time iter_chunks() spent reading chunks, across
+    all of its threads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.read_seconds = 0.0
+        self.lock = threading.Lock()
+        with open(filename, "rb") as region_file:
+            self.file_size = os.fstat(region_file.fileno()).st_size
+            if self.file_size < 2 * SECTOR_LENGTH:
+                # Empty (or truncated) region files hold no chunks
+                self.map = None
+                (self.locations, self.timestamps) = read_header(region_file)
+            else:
+                self.map = mmap.mmap(region_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.locations = [(location >> 8, location & 255) for location in
+                                  struct.unpack_from(">1024I", self.map, 0)]
+                self.timestamps = list(struct.unpack_from(">1024I", self.map, SECTOR_LENGTH))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def chunk_indexes(self):
+        """Return the chunk_index() of every chunk present in the header"""
+        return [index for (index, (offset, sectors)) in enumerate(self.locations)
+                if offset >= 2 and sectors > 0]
+
+    def read(self, index):
+        """
+        Return the decompressed NBT data of a chunk, or None if it is missing,
+        does not fit in the file, or does not decompress.
+        """
+        (offset, sectors) = self.locations[index]
+        start = offset * SECTOR_LENGTH
+        if self.map is None or offset < 2 or sectors == 0 or start + 5 > self.file_size:
+            return None
+        (length, compression) = struct.unpack_from(">IB", self.map, start)
+        if length <= 1 or start + 4 + length > self.file_size:
+            return None
+        data = buffer(self.map, start + 5, length - 1)
+        try:
+            if compression == COMPRESSION_ZLIB:
+                return zlib.decompress(data)
+            if compression == COMPRESSION_GZIP:
+                return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            if compression == COMPRESSION_NONE:
+                return bytes(data)
+        except zlib.error:
+            pass
+        return None
+
+    def timed_read(self, index):
+        """read(), adding the time it took to read_seconds"""
+        start = time.time()
+        data = self.read(index)
+        elapsed = time.time() - start
+        with self.lock:
+            self.read_seconds += elapsed
+        return data
+
+    def iter_chunks(self, indexes, pool=None, window=16):
+        """
+        Yield (index, data) for the given chunk indexes, in order, data as
+        returned by read(). With a ThreadPool, up to window chunks are
+        decompressed ahead of the consumer. zlib releases the GIL, so this
+        overlaps with the processing of the chunks already handed out.
+        """
+        if pool is None:
+            for index in indexes:
+                yield (index, self.timed_read(index))
+            return
+        pending = deque()
+        for index in indexes:
+            pending.append((index, pool.apply_async(self.timed_read, (index,))))
+            if len(pending) >= window:
+                (index, result) = pending.popleft()
+                yield (index, result.get())
+        while pending:
+            (index, result) = pending.popleft()
+            yield (index, result.get())
+
+class ChunkWriter(object):
+    """
+    Runs write(index, chunk) for modified chunks on a thread of its own, so
+    serializing, compressing and writing them overlaps the processing of the
+    chunks that follow. At most depth chunks wait for the thread, put()
+    blocks beyond that, which caps the memory they hold. seconds totals the
+    time spent in write. An exception raised by write is raised again by
+    put() or close(), the chunks queued after it are dropped.
+    """
+    def __init__(self, write, depth=16):
+        self.write = write
+        self.queue = Queue(maxsize=depth)
+        self.seconds = 0.0
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            start = time.time()
+            try:
+                self.write(*item)
+            except Exception:
+                self.error = sys.exc_info()
+            self.seconds += time.time() - start
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def put(self, index, chunk):
+        self.raise_error()
+        self.queue.put((index, chunk))
+
+    def close(self):
+        """Wait for every queued chunk to be written"""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+def serialize_chunk(nbt_file):
+    """Render an NBTFile as uncompressed NBT data"""
+    data = BytesIO()
+    nbt_file.write_file(buffer=data)
+    return data.getvalue()
+
+def compress_record(data, level=-1):
+    """Return NBT data as a zlib compressed chunk record"""
+    data = zlib.compress(data, level)
+    return struct.pack(">IB", len(data) + 1, COMPRESSION_ZLIB) + data
+
+def compress_chunk(nbt_file, level=-1):
+    """Render an NBTFile and return it as a zlib compressed chunk record"""
+    return compress_record(serialize_chunk(nbt_file), level)
+
+def write_record(region, index, record):
+    """
+    Write a chunk record (see compress_record) in place, into an open
+    nbt.region.RegionFile. write_blockdata() compresses at its own level, so
+    the compressed data is handed to it as uncompressed, and the compression
+    type is fixed up once it has found the chunk a place.
+    """
+    (x, z) = (index % 32, index // 32)
+    region.write_blockdata(x, z, record[5:], compression=nbt.region.COMPRESSION_NONE)
+    region.file.seek(region.metadata[x, z].blockstart * SECTOR_LENGTH + 4)
+    region.file.write(record[4:5])
+
+def rewrite_region(filename, modified):
+    """
+    Write a compacted copy of a region file in one sequential pass, and swap
+    it in place of the original with an atomic rename.
+    modified maps chunk_index() to the new chunk record (see compress_chunk),
+    every other chunk is copied over as its raw compressed bytes.
+    Returns the number of chunks written.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    (handle, temp_name) = tempfile.mkstemp(prefix=os.path.basename(filename) + ".",
+                                           suffix=".tmp", dir=directory)
+    now = int(time.time())
+    written = 0
+    try:
+        with open(filename, "rb") as source, os.fdopen(handle, "wb") as target:
+            file_size = os.fstat(source.fileno()).st_size
+            (locations, timestamps) = read_header(source)
+            new_locations = [0] * CHUNKS_PER_REGION
+            new_timestamps = [0] * CHUNKS_PER_REGION
+            target.write(b"\x00" * 2 * SECTOR_LENGTH)
+            sector = 2
+            for index in range(CHUNKS_PER_REGION):
+                if index in modified:
+                    record = modified[index]
+                    timestamp = now
+                else:
+                    record = read_raw_chunk(source, locations[index], file_size)
+                    timestamp = timestamps[index]
+                if record is None:
+                    continue
+                sectors = (len(record) + SECTOR_LENGTH - 1) // SECTOR_LENGTH
+                if sectors > MAX_CHUNK_SECTORS:
+                    raise ValueError("Chunk %d of %s is too large (%d sectors exceeds %d maximum)"
+                                     % (index, filename, sectors, MAX_CHUNK_SECTORS))
+                target.write(record)
+                target.write(b"\x00" * (sectors * SECTOR_LENGTH - len(record)))
+                new_locations[index] = (sector << 8) | sectors
+                new_timestamps[index] = timestamp
+                sector += sectors
+                written += 1
+            target.seek(0)
+            target.write(struct.pack(">1024I", *new_locations))
+            target.write(struct.pack(">1024I", *new_timestamps))
+            target.flush()
+            os.fsync(target.fileno())
+        shutil.copymode(filename, temp_name)
+        replace_file(temp_name, filename)
+    except:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    return written
+
+def replace_file(source, destination):
+    """Rename source over destination, atomically where the OS allows it"""
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # Windows refuses to rename over an existing file
+        if os.name != "nt":
+            raise
+        os.remove(destination)
+        os.rename(source, destination)
@@ -0,0 +1,136 @@
+"""
+Compile a replacements file (see README.md) into lookup tables.
+
+Every block ID:Data pair is given a slot in a dense 4096x16 table holding the
+ID and Data it should be rewritten to, so unconditional toID/toData/adjustData
+replacements can be applied to a whole section with a single numpy lookup.
+The table holds the result for blocks without a tile entity. Pairs whose
+replacement depends on the tile entity (NBT matches, deleting the tile entity
+or editing its tags) are flagged, and only the positions of those pairs that
+do have a tile entity need to be looked at one by one.
+"""
+import json
+from collections import OrderedDict
+import numpy as np
+from utilities import MAX_BLOCK_ID, MAX_DATA, BLOCK_STATES
+
+# Properties of a Data object that are not NBT match objects
+RULE_PROPERTIES = frozenset(["title", "toID", "toData", "adjustData", "delete",
+                             "deleteNBT", "toNBT", "fromNBT"])
+
+class Rule(object):
+    """
+    A single replacement, either the Data object itself or one of the NBT
+    match objects declared inside of it.
+    """
+    def __init__(self, title, spec):
+        self.title = spec.get("title", title)
+        self.to_id = spec.get("toID")
+        self.to_data = spec.get("toData")
+        self.adjust_data = spec.get("adjustData")
+        self.delete = bool(spec.get("delete", False))
+        self.from_nbt = spec.get("fromNBT")
+        self.to_nbt = spec.get("toNBT")
+        self.delete_nbt = spec.get("deleteNBT")
+
+    def touches_tile(self):
+        """True if this rule needs to look at, or change, the tile entity"""
+        return (self.delete or self.from_nbt is not None or
+                self.to_nbt is not None or self.delete_nbt is not None)
+
+    def matches(self, tile):
+        """Check the fromNBT pattern against a TAG_Compound (or None)"""
+        if self.from_nbt is None:
+            return True
+        if tile is None:
+            return False
+        for tag, tag_data in self.from_nbt.viewitems():
+            if tag not in tile or tile[tag].value != tag_data:
+                return False
+        return True
+
+    def apply(self, block, data):
+        """Return the new (block, data) pair for this rule"""
+        if self.to_id is not None:
+            block = self.to_id
+        if self.to_data is not None:
+            data = self.to_data
+        if self.adjust_data is not None:
+            data += self.adjust_data
+        return (block % MAX_BLOCK_ID, data % MAX_DATA)
+
+class CompiledRules(object):
+    """
+    Lookup tables built from a replacements dict. Tables are flat, and are
+    indexed with block states, see utilities.block_states().
+    """
+    def __init__(self, replacements):
+        keys = np.arange(BLOCK_STATES)
+        self.to_id = (keys // MAX_DATA).astype(np.uint16)
+        self.to_data = (keys % MAX_DATA).astype(np.uint8)
+        # ID:Data pairs that have to go through the per block slow path when
+        # the block has a tile entity
+        self.conditional = np.zeros(BLOCK_STATES, dtype=bool)
+        # (base rule, [NBT match rules]) for every ID:Data pair with a rule
+        self.rules = {}
+        for block_id, by_data in replacements.viewitems():
+            block_id = int(block_id)
+            for data in range(MAX_DATA):
+                if str(data) in by_data:
+                    spec = by_data[str(data)]
+                    title = "{}:{}".format(block_id, data)
+                elif "*" in by_data:
+                    spec = by_data["*"]
+                    title = "{}:*".format(block_id)
+                else:
+                    continue
+                base = Rule(title, spec)
+                matches = [Rule(name, match) for name, match in spec.viewitems()
+                           if name not in RULE_PROPERTIES and isinstance(match, dict)]
+                key = block_id * MAX_DATA + data
+                self.rules[key] = (base, matches)
+                # Without a tile entity only matches lacking fromNBT can apply
+                (new_id, new_data) = (block_id, data)
+                for match in matches:
+                    if match.from_nbt is None:
+                        (new_id, new_data) = match.apply(new_id, new_data)
+                        break
+                (self.to_id[key], self.to_data[key]) = base.apply(new_id, new_data)
+                self.conditional[key] = bool(matches) or base.touches_tile()
+        self.changed = ((self.to_id != keys // MAX_DATA) |
+                        (self.to_data != keys % MAX_DATA))
+        # Block states any rule could possibly change
+        self.active = self.changed | self.conditional
+
+    def __len__(self):
+        return len(self.rules)
+
+    def lookup(self, block, data):
+        """Return (base rule, [NBT match rules]) for a block, or None"""
+        return self.rules.get(block * MAX_DATA + data)
+
+    def matches_section(self, states):
+        """True if any block of a section has a rule that could change it"""
+        return bool(self.active[states].any())
+
+    def remap(self, states):
+        """
+        Apply the replacements for blocks without a tile entity to a section.
+        Returns the new (blocks, data) arrays.
+        """
+        return (self.to_id[states], self.to_data[states])
+
+    def changed_keys(self, states, exclude=()):
+        """
+        Return (keys, counts) of the ID:Data pairs remap() changed, leaving
+        out the positions in exclude.
+        """
+        if len(exclude):
+            states = np.delete(states, exclude)
+        return np.unique(states[self.changed[states]], return_counts=True)
+
+def load_rules(replacement_file_name):
+    """Load and compile a replacements file. Match objects keep file order."""
+    with open(replacement_file_name, 'r') as replacement_file:
+        replacements = json.load(replacement_file, object_pairs_hook=OrderedDict)
+    return CompiledRules(replacements)
@@ -0,0 +1,87 @@
+"""
+Counts of the blocks without a tile entity, kept in shared memory.
+
+Block counts have a fixed size, 4096 IDs by 16 data values, so rather than
+returning them from every task, each pool worker adds them to its own slot
+of a count array shared with the parent. The parent sums the slots when it
+needs the totals. Only the tile entity inventory, whose size depends on the
+world, goes back with the results.
+
+Counts are kept per dimension, and per band of Y levels. Bands are a whole
+number of 16 block high sections, so each section is counted in one band.
+"""
+import os
+import errno
+import ctypes
+from multiprocessing import RawArray, Lock
+import numpy as np
+from utilities import BLOCK_STATES, MAX_DATA
+
+WORLD_HEIGHT = 256
+SECTION_HEIGHT = 16
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class SharedCounts(object):
+    """
+    A (slots, dimensions, bands, BLOCK_STATES) array of counts. Every worker
+    claims a slot in its initializer and only ever adds to that one, so no
+    locking is needed. The pid of the worker holding each slot is kept in
+    owners. A worker started in place of one that died takes over the slot
+    of a pid that no longer exists, keeping the counts already in it.
+    region_tags maps every region file to the name of the
+    dimension it is counted in.
+    """
+    def __init__(self, slots, region_tags, band_height=WORLD_HEIGHT):
+        if band_height % SECTION_HEIGHT or not 0 < band_height <= WORLD_HEIGHT:
+            raise ValueError("Band height must be a multiple of %d, up to %d" % (SECTION_HEIGHT, WORLD_HEIGHT))
+        self.dimensions = sorted(set(region_tags.viewvalues()))
+        self.region_dimensions = dict((region_file, self.dimensions.index(tag))
+                                      for (region_file, tag) in region_tags.viewitems())
+        self.band_height = band_height
+        self.bands = -(-WORLD_HEIGHT // band_height)
+        self.shape = (slots, len(self.dimensions), self.bands, BLOCK_STATES)
+        self.array = RawArray(ctypes.c_int64, int(np.prod(self.shape)))
+        self.owners = RawArray(ctypes.c_int, slots)
+        self.lock = Lock()
+
+    def counts(self):
+        return np.ctypeslib.as_array(self.array).reshape(self.shape)
+
+    def claim_slot(self):
+        """Return the (dimensions, bands, BLOCK_STATES) counts of a new worker"""
+        with self.lock:
+            for (slot, owner) in enumerate(self.owners):
+                if owner == 0 or not process_exists(owner):
+                    self.owners[slot] = os.getpid()
+                    return self.counts()[slot]
+        raise RuntimeError("All %d count slots are held by running workers" % self.shape[0])
+
+    def dimension(self, region_file):
+        """Index of the dimension a region file belongs to"""
+        return self.region_dimensions[region_file]
+
+    def band(self, section_y):
+        return min(max(section_y * SECTION_HEIGHT // self.band_height, 0), self.bands - 1)
+
+    def totals(self):
+        """Return the counts of all workers, as a (dimensions, bands, BLOCK_STATES) array"""
+        return self.counts().sum(axis=0)
+
+    def block_totals(self):
+        """Return the world wide count of every block state"""
+        return self.totals().sum(axis=(0, 1))
+
+    def save(self, filename):
+        """
+        Write the counts to an .npz file, with a (bands, block ID, data) array
+        for each dimension, and the band height.
+        """
+        totals = self.totals().reshape(len(self.dimensions), self.bands, BLOCK_STATES // MAX_DATA, MAX_DATA)
+        arrays = dict(zip(self.dimensions, totals))
+        np.savez_compressed(filename, band_height=self.band_height, **arrays)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic Anvil world, to benchmark WorldAnalysis.py against.
+
+Sections are filled with a mix of common blocks, blocks the example
+replacement files have rules for, and modded blocks with IDs above 255 that
+need the Add array. Some of the blocks that can carry a tile entity are
+given one, with tags drawn from a configurable number of distinct values.
+Chunks also hold a few entities and pending block ticks, which the analysis
+never reads but has to skip over.
+The same arguments and seed always produce the same world.
+"""
+import os, sys
+import argparse
+import numpy as np
+from nbt.nbt import (NBTFile, TAG_Compound, TAG_List, TAG_Int, TAG_Long, TAG_Byte,
+                     TAG_Byte_Array, TAG_Int_Array)
+from utilities import encode_section, pack_nbt, MAX_DATA
+from region_io import chunk_index, compress_chunk, rewrite_region, CHUNKS_PER_REGION
+
+# (block ID, relative weight) of the blocks sections are filled with
+COMMON_BLOCKS = [(0, 30), (1, 40), (3, 10), (2, 4), (4, 2), (13, 2), (12, 1), (9, 3),
+                 (16, 1), (15, 1), (14, 1), (56, 1)]
+# Blocks that Examples/Replace.json and Examples/vanilla.json have rules for
+RULE_BLOCKS = [(17, 2), (79, 1), (64, 1), (166, 1), (250, 1), (228, 1), (140, 1)]
+MODDED_BLOCKS = [(458, 2), (790, 2), (1475, 1), (1942, 1), (2001, 1), (3483, 1)]
+# Blocks given a tile entity, with the tile entity ID used for them
+TILE_BLOCKS = {166: "GenericPipe", 250: "TileMachine", 228: "TileGenerator", 140: "Personal Safe"}
+PIPE_IDS = [4307, 4310, 4000, 4001, 4002]
+
+def block_palette(weights):
+    (block_ids, counts) = zip(*weights)
+    counts = np.array(counts, dtype=float)
+    return (np.array(block_ids, dtype=np.uint16), counts / counts.sum())
+
+def make_tile(rng, block_id, x, y, z, nbt_variety):
+    tile = {"id": TILE_BLOCKS[block_id], "x": x, "y": y, "z": z,
+            "energy": int(rng.randint(nbt_variety)), "owner": "player%d" % rng.randint(nbt_variety)}
+    if block_id == 166:
+        tile["pipeId"] = PIPE_IDS[rng.randint(len(PIPE_IDS))]
+    return pack_nbt(tile)
+
+def make_entity(rng, chunkx, chunkz):
+    (x, z) = (chunkx * 16 + rng.random_sample() * 16, chunkz * 16 + rng.random_sample() * 16)
+    return pack_nbt({"id": ["Zombie", "Skeleton", "Item"][rng.randint(3)],
+                     "Pos": [x, 64.0 + rng.random_sample() * 32, z], "Motion": [0.0, -0.08, 0.0],
+                     "CustomName": "mob%d" % rng.randint(100), "Fire": -1,
+                     "Attributes": [{"Name": "generic.maxHealth", "Base": 20.0},
+                                    {"Name": "generic.movementSpeed", "Base": 0.23}],
+                     "Equipment": [{"id": 267, "Count": 1, "Damage": int(rng.randint(50))}, {}]})
+
+def make_tile_tick(rng, chunkx, chunkz):
+    return pack_nbt({"i": 8, "x": chunkx * 16 + int(rng.randint(16)), "y": int(rng.randint(256)),
+                     "z": chunkz * 16 + int(rng.randint(16)), "t": int(rng.randint(20)), "p": 0})
+
+def make_chunk(rng, chunkx, chunkz, options, stats):
+    """Build the NBTFile of a single chunk at absolute chunk coordinates"""
+    chunk = NBTFile()
+    level = TAG_Compound(name="Level")
+    chunk.tags.append(level)
+    level.tags.append(TAG_Int(name="xPos", value=chunkx))
+    level.tags.append(TAG_Int(name="zPos", value=chunkz))
+    level.tags.append(TAG_Long(name="LastUpdate", value=int(rng.randint(1 << 30))))
+    level.tags.append(TAG_Byte(name="TerrainPopulated", value=1))
+    biomes = TAG_Byte_Array(name="Biomes")
+    biomes.value = bytearray(rng.randint(0, 40, 256).astype(np.uint8).tobytes())
+    level.tags.append(biomes)
+    height_map = TAG_Int_Array(name="HeightMap")
+    height_map.value = rng.randint(0, 256, 256).tolist()
+    level.tags.append(height_map)
+    entities = TAG_List(name="Entities", type=TAG_Compound)
+    for _ in range(rng.poisson(options.entities)):
+        entities.tags.append(make_entity(rng, chunkx, chunkz))
+        stats["entities"] += 1
+    level.tags.append(entities)
+    tile_ticks = TAG_List(name="TileTicks", type=TAG_Compound)
+    for _ in range(rng.poisson(options.entities)):
+        tile_ticks.tags.append(make_tile_tick(rng, chunkx, chunkz))
+    level.tags.append(tile_ticks)
+    sections = TAG_List(name="Sections", type=TAG_Compound)
+    tile_entities = TAG_List(name="TileEntities", type=TAG_Compound)
+    section_count = max(1, min(16, rng.poisson(options.sections)))
+    for y in sorted(rng.choice(16, section_count, replace=False)):
+        palette = options.palette
+        if rng.random_sample() < options.add_fraction:
+            palette = options.modded_palette
+        blocks = rng.choice(palette[0], 4096, p=palette[1])
+        data = rng.randint(0, MAX_DATA, 4096).astype(np.uint8)
+        data[blocks < 17] = 0
+        section = TAG_Compound()
+        section.tags.append(TAG_Byte(name="Y", value=int(y)))
+        (block_tag, data_tag, add_tag) = encode_section(blocks, data)
+        section.tags.extend([block_tag, data_tag])
+        if add_tag is not None:
+            section.tags.append(add_tag)
+            stats["sections_with_add"] += 1
+        for tag_name in ("BlockLight", "SkyLight"):
+            light = TAG_Byte_Array(name=tag_name)
+            light.value = bytearray(2048)
+            section.tags.append(light)
+        sections.tags.append(section)
+        stats["sections"] += 1
+        for block_id in TILE_BLOCKS:
+            positions = np.flatnonzero(blocks == block_id)
+            positions = positions[rng.random_sample(len(positions)) < options.tile_density]
+            for i in positions.tolist():
+                x = chunkx * 16 + (i & 15)
+                z = chunkz * 16 + ((i >> 4) & 15)
+                tile_entities.tags.append(make_tile(rng, block_id, x, int(y) * 16 + (i >> 8), z,
+                                                    options.nbt_variety))
+                stats["tile_entities"] += 1
+    level.tags.extend([sections, tile_entities])
+    stats["chunks"] += 1
+    return chunk
+
+def generate_world(world_folder, regions=1, chunks=1024, sections=4.0, add_fraction=0.25,
+                   tile_density=0.05, nbt_variety=8, seed=0, entities=2.0):
+    """
+    Write a synthetic world to world_folder, which must not exist yet.
+    regions are laid out in a square around 0,0, each holding the first
+    chunks chunks of its 32x32 grid. sections is the average number of
+    sections per chunk, add_fraction the share of sections holding modded
+    block IDs. tile_density is the share of tile entity blocks given one.
+    entities is the average number of entities, and of block ticks, per chunk.
+    Returns a dict of what was generated.
+    """
+    rng = np.random.RandomState(seed)
+    options = argparse.Namespace(sections=sections, add_fraction=add_fraction,
+                                 tile_density=tile_density, nbt_variety=nbt_variety, entities=entities,
+                                 palette=block_palette(COMMON_BLOCKS + RULE_BLOCKS),
+                                 modded_palette=block_palette(COMMON_BLOCKS + RULE_BLOCKS + MODDED_BLOCKS))
+    stats = dict.fromkeys(["regions", "chunks", "sections", "sections_with_add", "tile_entities",
+                                "entities"], 0)
+    region_folder = os.path.join(world_folder, "region")
+    os.makedirs(region_folder)
+    # WorldFolder only needs the region files, but Minecraft wants a level.dat
+    open(os.path.join(world_folder, "level.dat"), "wb").close()
+    side = int(np.ceil(np.sqrt(regions)))
+    for n in range(regions):
+        (regionx, regionz) = (n % side - side // 2, n // side - side // 2)
+        filename = os.path.join(region_folder, "r.%d.%d.mca" % (regionx, regionz))
+        records = {}
+        for i in range(min(chunks, CHUNKS_PER_REGION)):
+            (chunkx, chunkz) = (regionx * 32 + i % 32, regionz * 32 + i // 32)
+            records[chunk_index(chunkx, chunkz)] = compress_chunk(
+                make_chunk(rng, chunkx, chunkz, options, stats))
+        # An empty file rewritten with every chunk as modified
+        open(filename, "wb").close()
+        rewrite_region(filename, records)
+        stats["regions"] += 1
+    stats["blocks"] = stats["sections"] * 4096
+    return stats
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Write a synthetic Anvil world for benchmarks.")
+    parser.add_argument("world_folder", metavar="WORLD_FOLDER")
+    parser.add_argument("--regions", type=int, default=1)
+    parser.add_argument("--chunks", type=int, default=1024, help="chunks per region (default 1024)")
+    parser.add_argument("--sections", type=float, default=4.0,
+                        help="average number of sections per chunk (default 4)")
+    parser.add_argument("--add-fraction", type=float, default=0.25,
+                        help="share of sections with block IDs above 255 (default 0.25)")
+    parser.add_argument("--tile-density", type=float, default=0.05,
+                        help="share of tile entity blocks that have one (default 0.05)")
+    parser.add_argument("--nbt-variety", type=int, default=8,
+                        help="number of distinct values of each varying tile entity tag (default 8)")
+    parser.add_argument("--entities", type=float, default=2.0,
+                        help="average number of entities, and of pending block ticks, per chunk (default 2)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+if __name__ == '__main__':
+    options = argument_parser().parse_args()
+    if os.path.exists(options.world_folder):
+        print("%s already exists" % options.world_folder)
+        sys.exit(73) # EX_CANTCREAT
+    stats = generate_world(options.world_folder, options.regions, options.chunks, options.sections,
+                           options.add_fraction, options.tile_density, options.nbt_variety, options.seed,
+                           options.entities)
+    print("Wrote %(regions)d regions, %(chunks)d chunks, %(sections)d sections "
+          "(%(sections_with_add)d with Add), %(tile_entities)d tile entities and "
+          "%(entities)d entities" % stats)
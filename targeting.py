@@ -0,0 +1,112 @@
+"""
+Restricting a run to part of a world.
+
+A Target is built from any combination of a box of chunks (or blocks), a
+radius around a point and a list of chunks, and holds the chunks inside all
+of them. Regions are matched by the r.X.Z coordinates in their file name,
+so those outside the target are never opened, and the chunks of the others
+are picked by their region_io.chunk_index(), which process_region checks
+against the region header before reading anything. A Y range limits the
+sections that are scanned, widened to whole 16 block high sections.
+"""
+import os
+import re
+from region_io import chunk_index
+
+REGION_NAME = re.compile(r"^r\.(-?\d+)\.(-?\d+)\.mc[ar]$")
+SECTION_HEIGHT = 16
+
+def region_coordinates(region_file):
+    """Return the (x, z) of a region file from its name, or None if it has none"""
+    match = REGION_NAME.match(os.path.basename(region_file))
+    if match is None:
+        return None
+    return (int(match.group(1)), int(match.group(2)))
+
+def load_chunk_list(filename):
+    """
+    Read a chunk list, a line of absolute "X Z" or "X,Z" chunk coordinates
+    per chunk. Blank lines and lines starting with # are ignored.
+    """
+    chunks = set()
+    with open(filename) as chunk_file:
+        for (number, line) in enumerate(chunk_file, 1):
+            line = line.split("#", 1)[0].replace(",", " ").split()
+            if not line:
+                continue
+            if len(line) != 2:
+                raise ValueError("%s:%d: expected X Z chunk coordinates" % (filename, number))
+            chunks.add((int(line[0]), int(line[1])))
+    return chunks
+
+def span_distance(low, high, point):
+    """Distance from point to the nearest of low..high, 0 if it is inside"""
+    return max(low - point, 0, point - high)
+
+def chunk_box(box):
+    """Order a box as (min x, min z, max x, max z)"""
+    return (min(box[0], box[2]), min(box[1], box[3]), max(box[0], box[2]), max(box[1], box[3]))
+
+class Target(object):
+    """
+    box is (min x, min z, max x, max z) in chunk coordinates, inclusive.
+    block_box is the same in block coordinates, widened to whole chunks.
+    radius is (x, z, r) in block coordinates, it takes in every chunk with a
+    block within r blocks of x,z. chunks is a set of (x, z) chunk coordinates.
+    y_range is (min y, max y) in block coordinates, inclusive.
+    Every part left as None does not restrict the target.
+    """
+    def __init__(self, box=None, block_box=None, radius=None, chunks=None, y_range=None):
+        self.boxes = []
+        if box is not None:
+            self.boxes.append(chunk_box(box))
+        if block_box is not None:
+            self.boxes.append(chunk_box([coordinate >> 4 for coordinate in block_box]))
+        self.radius = radius
+        self.chunks = chunks
+        self.chunk_regions = (set((x >> 5, z >> 5) for (x, z) in chunks) if chunks is not None else None)
+        self.sections = None
+        if y_range is not None:
+            self.sections = (min(y_range) // SECTION_HEIGHT, max(y_range) // SECTION_HEIGHT)
+
+    def limits_chunks(self):
+        return bool(self.boxes) or self.radius is not None or self.chunks is not None
+
+    def touches_area(self, min_x, min_z, max_x, max_z):
+        """True if the box of chunks could hold a chunk of the target"""
+        for box in self.boxes:
+            if max_x < box[0] or min_x > box[2] or max_z < box[1] or min_z > box[3]:
+                return False
+        if self.radius is not None:
+            (x, z, r) = self.radius
+            dx = span_distance(min_x * 16, max_x * 16 + 15, x)
+            dz = span_distance(min_z * 16, max_z * 16 + 15, z)
+            if dx * dx + dz * dz > r * r:
+                return False
+        return True
+
+    def contains_chunk(self, x, z):
+        return (self.touches_area(x, z, x, z) and
+                (self.chunks is None or (x, z) in self.chunks))
+
+    def region_chunks(self, region_file):
+        """
+        Return the chunk_index() of the target's chunks in a region, an empty
+        set for regions outside of it, or None if the whole region is inside.
+        """
+        if not self.limits_chunks():
+            return None
+        coordinates = region_coordinates(region_file)
+        if coordinates is None:
+            return set()
+        (region_x, region_z) = coordinates
+        (min_x, min_z) = (region_x * 32, region_z * 32)
+        if not self.touches_area(min_x, min_z, min_x + 31, min_z + 31):
+            return set()
+        if self.chunk_regions is not None and coordinates not in self.chunk_regions:
+            return set()
+        return set(chunk_index(x, z) for x in range(min_x, min_x + 32) for z in range(min_z, min_z + 32)
+                   if self.contains_chunk(x, z))
+
+    def contains_section(self, y):
+        return self.sections is None or self.sections[0] <= y <= self.sections[1]
@@ -0,0 +1,116 @@
+"""
+Per phase timing of process_region, and the reports made from it.
+
+Each task splits its wall time into the phases below with a PhaseTimer, and
+returns the totals in its stats Counter under ("seconds", phase) keys, so
+they are summed along with the other stats. The timing report lists the
+totals and every region, slowest first, flagging the regions that took much
+longer per MB than the median region did.
+
+With --profile every pool worker runs cProfile around its tasks, and dumps
+its stats into a scratch folder that merge_profiles() combines at the end.
+"""
+import os
+import time
+import json
+import pstats
+
+# The phases of process_region, in the order they happen to a chunk
+# read:       waiting for the region reader to hand over a chunk
+# decompress: reading and decompressing chunks, on the decompress threads
+#             when there are any, so it overlaps the other phases
+# parse:      the selective NBT read, see nbt_reader.py
+# scan:       decoding sections, counting blocks and tile entities
+# match:      checking sections against the replacement rules
+# full_parse: parsing chunks that need replacements with the nbt package
+# replace:    applying the rules, and re-encoding the changed sections
+# compress:   serializing modified chunks, and compressing them on the thread
+#             pool (or the writer thread without one), so it overlaps the
+#             other phases as well
+# write:      writing chunks in place on the writer thread, waiting for it
+#             to catch up, and rewriting the region file
+PHASES = ("read", "decompress", "parse", "scan", "match", "full_parse", "replace", "compress", "write")
+# Regions taking this many times the median seconds per MB are outliers
+OUTLIER_RATIO = 3.0
+# Small regions are counted as this many MB, so their fixed costs do not
+# make them stand out
+MIN_REGION_MB = 0.25
+
+class PhaseTimer(object):
+    """
+    lap(phase) charges the time since the previous lap to phase, so timing
+    a phase costs one clock read. Totals are added to stats.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+        self.start = self.last = time.time()
+
+    def lap(self, phase):
+        now = time.time()
+        self.stats[("seconds", phase)] += now - self.last
+        self.last = now
+
+    def stop(self):
+        """Record the total wall time of the task"""
+        self.stats[("seconds", "total")] += time.time() - self.start
+
+def phase_seconds(stats):
+    """Return {phase: seconds} of the ("seconds", phase) entries of stats"""
+    return dict((key[1], seconds) for (key, seconds) in stats.viewitems()
+                if isinstance(key, tuple) and key[0] == "seconds")
+
+def counters(stats):
+    """Return the plain counters of stats, leaving out timings and changes"""
+    return dict((key, count) for (key, count) in stats.viewitems() if not isinstance(key, tuple))
+
+def format_phases(stats):
+    seconds = phase_seconds(stats)
+    return ", ".join("%s %.2f s" % (phase, seconds[phase]) for phase in PHASES if seconds.get(phase))
+
+def region_report(region_stats, region_sizes):
+    """
+    Return the per region entries of the timing report, slowest first, and
+    the list of outlier regions among them.
+    """
+    regions = []
+    for (region_file, stats) in region_stats.viewitems():
+        seconds = phase_seconds(stats)
+        megabytes = region_sizes[region_file] / float(1024 * 1024)
+        regions.append({"region": region_file, "bytes": region_sizes[region_file],
+                        "seconds": seconds.get("total", 0.0),
+                        "seconds_per_mb": seconds.get("total", 0.0) / max(megabytes, MIN_REGION_MB),
+                        "phases": seconds, "counters": counters(stats)})
+    regions.sort(key=lambda region: region["seconds"], reverse=True)
+    outliers = []
+    if regions:
+        rates = sorted(region["seconds_per_mb"] for region in regions)
+        median = rates[len(rates) // 2]
+        for region in regions:
+            region["outlier"] = median > 0 and region["seconds_per_mb"] > OUTLIER_RATIO * median
+            if region["outlier"]:
+                outliers.append(region)
+    return (regions, outliers)
+
+def write_report(filename, stats, region_stats, region_sizes, wall_seconds):
+    """Write the timing report as JSON, and return the outlier regions"""
+    (regions, outliers) = region_report(region_stats, region_sizes)
+    report = {"wall_seconds": wall_seconds, "phases": phase_seconds(stats),
+              "counters": counters(stats), "outliers": [region["region"] for region in outliers],
+              "regions": regions}
+    with open(filename, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    return outliers
+
+def merge_profiles(profile_folder, filename):
+    """
+    Merge the cProfile dumps the workers left in profile_folder into a
+    single pstats file. Returns the number of dumps merged.
+    """
+    dumps = [os.path.join(profile_folder, name) for name in sorted(os.listdir(profile_folder))]
+    if not dumps:
+        return 0
+    stats = pstats.Stats(dumps[0])
+    for dump in dumps[1:]:
+        stats.add(dump)
+    stats.dump_stats(filename)
+    return len(dumps)
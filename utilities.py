@@ -1,4 +1,11 @@
-from nbt.nbt import _TAG_End
+from nbt.nbt import _TAG_End, TAG_Byte_Array
+import numpy as np
+
+MAX_BLOCK_ID = 4096
+MAX_DATA = 16
+# Number of distinct block ID:Data pairs, see block_states()
+BLOCK_STATES = MAX_BLOCK_ID * MAX_DATA
+
 def array_4bit_to_byte(array):
     """Convert a 2048-byte array of 4096 4-bit values to an array of 4096 1-byte values.
     The result is of type bytearray().
@@ -28,6 +35,79 @@ def array_byte_to_4bit(array):
             yield(((b2 & 15) << 4) + (b1 & 15))
     return bytearray(iterarray(array))
 
+def as_uint8(array):
+    """View a bytearray, str or memoryview as a numpy uint8 array, without copying"""
+    return np.asarray(memoryview(array)).view(np.uint8)
+
+def nibbles_to_array(array):
+    """Vectorized version of array_4bit_to_byte().
+    The result is a numpy uint8 array holding twice as many values as the
+    input, with the same nibble ordering as array_4bit_to_byte().
+    """
+    packed = as_uint8(array)
+    unpacked = np.empty(packed.size * 2, dtype=np.uint8)
+    unpacked[0::2] = packed & 15
+    unpacked[1::2] = packed >> 4
+    return unpacked
+
+def array_to_nibbles(array):
+    """Vectorized version of array_byte_to_4bit().
+    Accepts any integer numpy array (or sequence), values are taken modulo 16.
+    The result is of type bytearray().
+    """
+    array = np.asarray(array) & 15
+    if array.size % 2:
+        array = np.append(array, 0)
+    packed = (array[1::2] << 4) | array[0::2]
+    return bytearray(packed.astype(np.uint8).tobytes())
+
+def decode_section(section):
+    """Decode the Blocks, Add and Data arrays of an Anvil section.
+    Returns a tuple (blocks, data) of 4096 entry numpy arrays, the block IDs
+    as uint16 with the Add nibbles already merged in, and the data values as
+    uint8. Both arrays are indexed in YZX order, like the section itself.
+    """
+    add = section["Add"].value if "Add" in section else None
+    return decode_arrays(section["Blocks"].value, section["Data"].value, add)
+
+def decode_arrays(blocks, data, add=None):
+    """decode_section() for the raw Blocks, Data and Add (or None) byte arrays
+    of a section, as bytearrays or memoryviews (see nbt_reader.py).
+    """
+    blocks = as_uint8(blocks).astype(np.uint16)
+    if add is not None:
+        blocks |= nibbles_to_array(add).astype(np.uint16) << 8
+    data = nibbles_to_array(data)
+    return (blocks, data)
+
+def encode_section(blocks, data):
+    """Encode block IDs and data values back into section tags.
+    This is the inverse of decode_section(), and returns a tuple of
+    TAG_Byte_Array (Blocks, Data, Add). Add is None when every block ID is
+    below 256, as Minecraft does not require the tag in that case.
+    """
+    blocks = np.asarray(blocks, dtype=np.uint16)
+    block_list = TAG_Byte_Array(name=u"Blocks")
+    block_list.value = bytearray((blocks & 255).astype(np.uint8).tobytes())
+    data_list = TAG_Byte_Array(name=u"Data")
+    data_list.value = array_to_nibbles(data)
+    if blocks.size and blocks.max() > 255:
+        add_list = TAG_Byte_Array(name=u"Add")
+        add_list.value = array_to_nibbles(blocks >> 8)
+    else:
+        add_list = None
+    return (block_list, data_list, add_list)
+
+def block_states(blocks, data):
+    """Pack block ID and data arrays into a single array of block states,
+    block_id * 16 + data, usable as an index into BLOCK_STATES sized tables.
+    """
+    return (blocks.astype(np.intp) << 4) | data
+
+def section_index(x, y, z):
+    """Return the index of block x,y,z within the arrays of its section"""
+    return ((y & 15) << 8) | ((z & 15) << 4) | (x & 15)
+
 def unpack_nbt(tag):
     from nbt.nbt import NBTFile, TAG_Long, TAG_Int, TAG_String, TAG_List, TAG_Compound
     """